@@ -0,0 +1,137 @@
+# cython: cdivision=True
+# distutils: language=c++
+
+from libc.stdint cimport uint8_t
+from libcpp.vector cimport vector
+
+
+cpdef bytearray decompress_gcz(const unsigned char[:] data, size_t decomp_size=0):
+    # decomp_size is only used to size the output buffer up front and can be 0 when unknown
+    cdef vector[uint8_t] output
+    cdef size_t data_length = data.shape[0]
+    cdef size_t offset = 0
+    cdef unsigned char flag = 0
+    cdef unsigned char cmd1 = 0
+    cdef unsigned char cmd2 = 0
+    cdef int bit = 0
+    cdef int lookback_length = 0
+    cdef long lookback_offset = 0
+    cdef long loffset = 0
+
+    output.reserve(decomp_size if decomp_size > 0 else data_length * 2)
+
+    while offset < data_length:
+        flag = data[offset]
+        offset += 1
+
+        for bit in range(8):
+            if flag & (1 << bit):
+                if offset >= data_length:
+                    raise IndexError("Unexpected end of GCZ data")
+
+                output.push_back(data[offset])
+                offset += 1
+
+            else:
+                if offset + 2 > data_length:
+                    break
+
+                cmd1 = data[offset]
+                cmd2 = data[offset + 1]
+                lookback_length = (cmd1 & 0x0f) + 3
+                lookback_offset = ((cmd1 & 0xf0) << 4) + cmd2
+                offset += 2
+
+                if cmd1 == 0 and cmd2 == 0:
+                    break
+
+                while lookback_length > 0:
+                    loffset = <long>output.size() - lookback_offset
+
+                    if loffset <= 0 or loffset >= <long>output.size():
+                        output.push_back(0)
+
+                    else:
+                        output.push_back(output[loffset])
+
+                    lookback_length -= 1
+
+    if output.size() == 0:
+        return bytearray()
+
+    return bytearray((<char*>output.data())[:output.size()])
+
+
+cpdef bytearray compress_gcz(const unsigned char[:] data, int max_chain=256):
+    # Greedy LZ77 using hash chains on 3 byte prefixes.
+    # Copies are 3 to 18 bytes long and can reach back up to 0xfff bytes, but can't
+    # start at the first byte since the decompressor treats that as a zero fill.
+    cdef vector[int] head = vector[int](0x10000, -1)
+    cdef vector[int] prev = vector[int](max(<int>data.shape[0], 1), -1)
+    cdef vector[uint8_t] output
+    cdef int data_length = data.shape[0]
+    cdef int offset = 0
+    cdef int inserted = 0
+    cdef int history_idx = 0
+    cdef int chain = 0
+    cdef int key = 0
+    cdef int i = 0
+    cdef int best_length = 0
+    cdef int best_distance = 0
+    cdef size_t flag_offset = 0
+    cdef int flag_bit = 8
+
+    while offset < data_length:
+        if flag_bit == 8:
+            flag_offset = output.size()
+            output.push_back(0)
+            flag_bit = 0
+
+        while inserted < offset and inserted + 2 < data_length:
+            key = ((data[inserted] << 8) ^ (data[inserted + 1] << 4) ^ data[inserted + 2]) & 0xffff
+            prev[inserted] = head[key]
+            head[key] = inserted
+            inserted += 1
+
+        best_length = 0
+        best_distance = 0
+
+        if offset + 2 < data_length:
+            history_idx = head[((data[offset] << 8) ^ (data[offset + 1] << 4) ^ data[offset + 2]) & 0xffff]
+            chain = 0
+
+            while history_idx > 0 and offset - history_idx <= 0xfff and chain < max_chain:
+                i = 0
+                while i < 18 and offset + i < data_length and data[history_idx + i] == data[offset + i]:
+                    i += 1
+
+                if i > best_length:
+                    best_length = i
+                    best_distance = offset - history_idx
+
+                    if i == 18:
+                        break
+
+                history_idx = prev[history_idx]
+                chain += 1
+
+        if best_length >= 3:
+            output.push_back(((best_distance >> 4) & 0xf0) | (best_length - 3))
+            output.push_back(best_distance & 0xff)
+            offset += best_length
+
+        else:
+            output[flag_offset] |= 1 << flag_bit
+            output.push_back(data[offset])
+            offset += 1
+
+        flag_bit += 1
+
+    # Terminate with an empty copy command
+    if flag_bit == 8:
+        output.push_back(0)
+
+    output.push_back(0)
+    output.push_back(0)
+
+    return bytearray((<char*>output.data())[:output.size()])
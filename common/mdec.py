@@ -0,0 +1,286 @@
+#
+# PlayStation MDEC bitstream (.bs) frame decoder shared by the video tools in this repository.
+# Decodes version 1, 2 and 3 frames the way the PlayStation's MDEC does without needing jPSXdec.
+#
+
+import struct
+
+import numpy
+
+
+# MPEG-1 DCT coefficient codes used by the bitstream, without the sign bit: (code, run, level)
+AC_CODES = [
+    ("11", 0, 1), ("011", 1, 1), ("0100", 0, 2), ("0101", 2, 1), ("00101", 0, 3), ("00111", 3, 1),
+    ("00110", 4, 1), ("000110", 1, 2), ("000111", 5, 1), ("000101", 6, 1), ("000100", 7, 1),
+    ("0000110", 0, 4), ("0000100", 2, 2), ("0000111", 8, 1), ("0000101", 9, 1),
+    ("00100110", 0, 5), ("00100001", 0, 6), ("00100101", 1, 3), ("00100100", 3, 2), ("00100111", 10, 1),
+    ("00100011", 11, 1), ("00100010", 12, 1), ("00100000", 13, 1),
+    ("0000001010", 0, 7), ("0000001100", 1, 4), ("0000001011", 2, 3), ("0000001111", 4, 2),
+    ("0000001001", 5, 2), ("0000001110", 14, 1), ("0000001101", 15, 1), ("0000001000", 16, 1),
+    ("000000011101", 0, 8), ("000000011000", 0, 9), ("000000010011", 0, 10), ("000000010000", 0, 11),
+    ("000000011011", 1, 5), ("000000010100", 2, 4), ("000000011100", 3, 3), ("000000010010", 4, 3),
+    ("000000011110", 6, 2), ("000000010101", 7, 2), ("000000010001", 8, 2), ("000000011111", 17, 1),
+    ("000000011010", 18, 1), ("000000011001", 19, 1), ("000000010111", 20, 1), ("000000010110", 21, 1),
+    ("0000000011010", 0, 12), ("0000000011001", 0, 13), ("0000000011000", 0, 14), ("0000000010111", 0, 15),
+    ("0000000010110", 1, 6), ("0000000010101", 1, 7), ("0000000010100", 2, 5), ("0000000010011", 3, 4),
+    ("0000000010010", 5, 3), ("0000000010001", 9, 2), ("0000000010000", 10, 2), ("0000000011111", 22, 1),
+    ("0000000011110", 23, 1), ("0000000011101", 24, 1), ("0000000011100", 25, 1), ("0000000011011", 26, 1),
+    ("00000000011111", 0, 16), ("00000000011110", 0, 17), ("00000000011101", 0, 18), ("00000000011100", 0, 19),
+    ("00000000011011", 0, 20), ("00000000011010", 0, 21), ("00000000011001", 0, 22), ("00000000011000", 0, 23),
+    ("00000000010111", 0, 24), ("00000000010110", 0, 25), ("00000000010101", 0, 26), ("00000000010100", 0, 27),
+    ("00000000010011", 0, 28), ("00000000010010", 0, 29), ("00000000010001", 0, 30), ("00000000010000", 0, 31),
+    ("000000000011000", 0, 32), ("000000000010111", 0, 33), ("000000000010110", 0, 34), ("000000000010101", 0, 35),
+    ("000000000010100", 0, 36), ("000000000010011", 0, 37), ("000000000010010", 0, 38), ("000000000010001", 0, 39),
+    ("000000000010000", 0, 40), ("000000000011111", 1, 8), ("000000000011110", 1, 9), ("000000000011101", 1, 10),
+    ("000000000011100", 1, 11), ("000000000011011", 1, 12), ("000000000011010", 1, 13), ("000000000011001", 1, 14),
+    ("0000000000010011", 1, 15), ("0000000000010010", 1, 16), ("0000000000010001", 1, 17), ("0000000000010000", 1, 18),
+    ("0000000000010100", 6, 3), ("0000000000011010", 11, 2), ("0000000000011001", 12, 2), ("0000000000011000", 13, 2),
+    ("0000000000010111", 14, 2), ("0000000000010110", 15, 2), ("0000000000010101", 16, 2), ("0000000000011111", 27, 1),
+    ("0000000000011110", 28, 1), ("0000000000011101", 29, 1), ("0000000000011100", 30, 1), ("0000000000011011", 31, 1),
+]
+
+AC_EOB_CODE = "10"
+AC_ESCAPE_CODE = "000001"
+
+AC_PEEK_BITS = 17
+AC_EOB = -1
+AC_ESCAPE = -2
+
+# MPEG-1 DC size codes used by version 3 frames, indexed by size
+DC_LUMA_CODES = ["100", "00", "01", "101", "110", "1110", "11110", "111110", "1111110"]
+DC_CHROMA_CODES = ["00", "01", "10", "110", "1110", "11110", "111110", "1111110", "11111110"]
+
+DC_PEEK_BITS = 8
+
+# The PlayStation's default quantization table in raster order
+QUANT_TABLE = numpy.array([
+     2, 16, 19, 22, 26, 27, 29, 34,
+    16, 16, 22, 24, 27, 29, 34, 37,
+    19, 22, 26, 27, 29, 34, 34, 38,
+    22, 22, 26, 27, 29, 34, 37, 40,
+    22, 26, 27, 29, 32, 35, 40, 48,
+    26, 27, 29, 32, 35, 40, 48, 58,
+    26, 27, 29, 34, 38, 46, 56, 69,
+    27, 29, 35, 38, 46, 56, 69, 83,
+], dtype=numpy.int32)
+
+ZIGZAG = numpy.array([
+     0,  1,  8, 16,  9,  2,  3, 10,
+    17, 24, 32, 25, 18, 11,  4,  5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13,  6,  7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63,
+], dtype=numpy.int32)
+
+
+def build_lookup_table(codes, peek_bits):
+    # Every possible value of the next peek_bits bits maps to the entry whose code it starts with
+    lengths = numpy.zeros(1 << peek_bits, dtype=numpy.int32)
+    values = [numpy.zeros(1 << peek_bits, dtype=numpy.int32) for _ in codes[0][1]]
+
+    for code, entry in codes:
+        start = int(code, 2) << (peek_bits - len(code))
+        end = (int(code, 2) + 1) << (peek_bits - len(code))
+
+        assert (not lengths[start:end].any())
+
+        lengths[start:end] = len(code)
+        for value, x in zip(values, entry):
+            value[start:end] = x
+
+    return [lengths.tolist()] + [value.tolist() for value in values]
+
+
+def build_ac_table():
+    codes = [(AC_EOB_CODE, (AC_EOB, 0)), (AC_ESCAPE_CODE, (AC_ESCAPE, 0))]
+
+    for code, run, level in AC_CODES:
+        codes.append((code + "0", (run, level)))
+        codes.append((code + "1", (run, -level)))
+
+    return build_lookup_table(codes, AC_PEEK_BITS)
+
+
+AC_LENGTH, AC_RUN, AC_LEVEL = build_ac_table()
+DC_LUMA_LENGTH, DC_LUMA_SIZE = build_lookup_table([(code, (size,)) for size, code in enumerate(DC_LUMA_CODES)], DC_PEEK_BITS)
+DC_CHROMA_LENGTH, DC_CHROMA_SIZE = build_lookup_table([(code, (size,)) for size, code in enumerate(DC_CHROMA_CODES)], DC_PEEK_BITS)
+
+
+def get_bit_windows(data):
+    # The bitstream is read as little endian 16-bit words starting from the most significant bit.
+    # Precalculating the next 32 bits at every bit position means any code can be read with a
+    # single list lookup and shift instead of going through a bit reader.
+    data = numpy.frombuffer(data, dtype='<u2', count=len(data) // 2).astype('>u2').view(numpy.uint8)
+    data = numpy.concatenate((data, numpy.zeros(8, dtype=numpy.uint8))).astype(numpy.uint64)
+
+    # 40 bits starting at every byte
+    byte_windows = (data[:-4] << 32) | (data[1:-3] << 24) | (data[2:-2] << 16) | (data[3:-1] << 8) | data[4:]
+
+    shifts = numpy.arange(8, 0, -1, dtype=numpy.uint64)
+    windows = (byte_windows[:, None] >> shifts[None, :]) & 0xffffffff
+
+    return windows.reshape(-1).tolist()
+
+
+def decode_coefficients(data, block_count):
+    # Walk the variable length codes of every block, returning each block's DC coefficient and a
+    # list of the AC coefficients as (block, zigzag index, level)
+    if len(data) < 8:
+        raise ValueError("Bitstream frame too short")
+
+    _, magic, qscale, version = struct.unpack_from("<HHHH", data)
+
+    if magic != 0x3800:
+        raise ValueError("Not a MDEC bitstream frame")
+
+    if version not in [1, 2, 3]:
+        raise ValueError("Unsupported bitstream version %d" % version)
+
+    windows = get_bit_windows(data[8:])
+
+    dc_levels = [0] * block_count
+    ac_blocks = []
+    ac_indices = []
+    ac_levels = []
+
+    # Blocks are stored as Cr, Cb, Y1, Y2, Y3, Y4 for every macroblock
+    dc_predictors = [0, 0, 0]
+
+    pos = 0
+    try:
+        for block in range(block_count):
+            if version == 3:
+                component = [2, 1, 0, 0, 0, 0][block % 6]
+
+                peek = windows[pos] >> (32 - DC_PEEK_BITS)
+                if component == 0:
+                    length, size = DC_LUMA_LENGTH[peek], DC_LUMA_SIZE[peek]
+
+                else:
+                    length, size = DC_CHROMA_LENGTH[peek], DC_CHROMA_SIZE[peek]
+
+                if length == 0:
+                    raise ValueError("Invalid DC code")
+
+                pos += length
+
+                diff = 0
+                if size > 0:
+                    diff = windows[pos] >> (32 - size)
+                    pos += size
+
+                    if diff < (1 << (size - 1)):
+                        diff -= (1 << size) - 1
+
+                dc_predictors[component] += diff * 4
+                dc_levels[block] = dc_predictors[component]
+
+            else:
+                dc = windows[pos] >> 22
+                pos += 10
+
+                dc_levels[block] = dc - 0x400 if dc & 0x200 else dc
+
+            k = 0
+            while True:
+                peek = windows[pos] >> (32 - AC_PEEK_BITS)
+                length = AC_LENGTH[peek]
+
+                if length == 0:
+                    raise ValueError("Invalid AC code")
+
+                run = AC_RUN[peek]
+
+                if run == AC_EOB:
+                    pos += length
+                    break
+
+                elif run == AC_ESCAPE:
+                    escape = (windows[pos] >> 10) & 0xffff
+                    pos += 22
+
+                    run = escape >> 10
+                    level = escape & 0x3ff
+                    level = level - 0x400 if level & 0x200 else level
+
+                else:
+                    level = AC_LEVEL[peek]
+                    pos += length
+
+                k += run + 1
+                if k > 63:
+                    raise ValueError("Too many AC coefficients in block")
+
+                ac_blocks.append(block)
+                ac_indices.append(k)
+                ac_levels.append(level)
+
+    except IndexError:
+        raise ValueError("Bitstream ended early")
+
+    return qscale, dc_levels, ac_blocks, ac_indices, ac_levels
+
+
+def get_idct_matrix():
+    x = numpy.arange(8)
+    matrix = numpy.cos((2 * x[None, :] + 1) * x[:, None] * numpy.pi / 16) * numpy.sqrt(2 / 8)
+    matrix[0] = numpy.sqrt(1 / 8)
+    return matrix
+
+
+IDCT_MATRIX = get_idct_matrix()
+
+
+def decode_bs(data, width, height):
+    # Decode a bitstream frame into signed Y, Cb and Cr planes the size of the macroblocks
+    mb_width = (width + 15) // 16
+    mb_height = (height + 15) // 16
+    block_count = mb_width * mb_height * 6
+
+    qscale, dc_levels, ac_blocks, ac_indices, ac_levels = decode_coefficients(bytes(data), block_count)
+
+    # Dequantize everything at once
+    coefficients = numpy.zeros((block_count, 64), dtype=numpy.int32)
+    coefficients[:, 0] = numpy.clip(numpy.array(dc_levels, dtype=numpy.int32) * QUANT_TABLE[0], -0x400, 0x3ff)
+
+    if ac_blocks:
+        positions = ZIGZAG[numpy.array(ac_indices, dtype=numpy.int32)]
+        levels = numpy.array(ac_levels, dtype=numpy.int32)
+        coefficients[numpy.array(ac_blocks, dtype=numpy.int32), positions] = numpy.clip((levels * QUANT_TABLE[positions] * qscale + 4) >> 3, -0x400, 0x3ff)
+
+    # 2D IDCT of every block
+    blocks = IDCT_MATRIX.T @ coefficients.reshape(-1, 8, 8).astype(numpy.float64) @ IDCT_MATRIX
+    blocks = numpy.clip(numpy.floor(blocks + 0.5), -128, 127).astype(numpy.int32)
+
+    # Macroblocks are stored top to bottom and then left to right
+    blocks = blocks.reshape(mb_width, mb_height, 6, 8, 8)
+
+    cr = blocks[:, :, 0].transpose(1, 2, 0, 3).reshape(mb_height * 8, mb_width * 8)
+    cb = blocks[:, :, 1].transpose(1, 2, 0, 3).reshape(mb_height * 8, mb_width * 8)
+    y = blocks[:, :, 2:].reshape(mb_width, mb_height, 2, 2, 8, 8).transpose(1, 2, 4, 0, 3, 5).reshape(mb_height * 16, mb_width * 16)
+
+    return y, cb, cr
+
+
+def ycbcr_to_rgb(y, cb, cr, width, height):
+    # Same conversion as the MDEC, which uses the nearest chroma sample for each pixel
+    cb = cb.repeat(2, axis=0).repeat(2, axis=1).astype(numpy.float64)
+    cr = cr.repeat(2, axis=0).repeat(2, axis=1).astype(numpy.float64)
+
+    rgb = numpy.empty(y.shape + (3,), dtype=numpy.float64)
+    rgb[:, :, 0] = y + 1.402 * cr
+    rgb[:, :, 1] = y - 0.3437 * cb - 0.7143 * cr
+    rgb[:, :, 2] = y + 1.772 * cb
+
+    rgb = numpy.clip(numpy.floor(rgb + 0.5), -128, 127) + 128
+
+    return rgb[:height, :width].astype(numpy.uint8)
+
+
+def decode_bs_image(data, width, height):
+    # Decode a bitstream frame into a (height, width, 3) RGB array
+    y, cb, cr = decode_bs(data, width, height)
+    return ycbcr_to_rgb(y, cb, cr, width, height)
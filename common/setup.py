@@ -0,0 +1,6 @@
+from distutils.core import setup
+from Cython.Build import cythonize
+
+setup(
+    ext_modules = cythonize(["gcz.pyx"], annotate=True, language_level=3)
+)
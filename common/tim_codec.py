@@ -0,0 +1,166 @@
+#
+# Vectorized PlayStation TIM image decoder shared by the tim2png scripts in this repository.
+# Based on tim2png by Christian Bauer <www.cebix.net>
+#
+
+import struct
+
+import numpy
+
+from PIL import Image
+
+
+# 5-bit colour component to 8-bit, the same values PIL uses for "BGR;15"
+COLOR_5BIT = (numpy.arange(32, dtype=numpy.uint16) * 255 // 31).astype(numpy.uint8)
+
+
+def read_tim(f):
+    # Parse a TIM file into its raw CLUT entries and pixel data without applying any palette.
+    # 4bpp and 8bpp images are returned as a 2D array of palette indices.
+    header = f.read(8)
+    if header[:4] != b"\x10\x00\x00\x00":
+        raise SyntaxError("Not a TIM file")
+
+    flags = struct.unpack_from("<I", header, 4)[0]
+    if flags & 0xfffffff0:
+        raise SyntaxError("Not a TIM file")
+
+    pMode = flags & 7
+    if pMode > 4:
+        raise SyntaxError("Not a TIM file")
+    elif pMode == 4:
+        raise ValueError("Mixed mode images not yet supported")
+
+    clut = None
+    clut_count = 0
+    if flags & 8:
+        clutSize = struct.unpack("<I", f.read(4))[0]
+        if clutSize < 12:
+            raise ValueError("Size of CLUT data too small")
+
+        numEntries = (clutSize - 12) // 2
+
+        f.read(8)  # skip DX/DY/H/W (frame buffer location and size)
+
+        clut = f.read(numEntries * 2)
+        clut = numpy.frombuffer(clut, dtype='<u2', count=len(clut) // 2).astype(numpy.uint16)
+
+        clut_count = numEntries // (0x100 if pMode == 1 else 0x10)
+
+    dataSize = struct.unpack("<I", f.read(4))[0]
+    if dataSize < 12:
+        raise ValueError("Size of pixel data too small")
+
+    f.read(4)  # skip DX/DY (frame buffer location)
+
+    width, height = struct.unpack("<HH", f.read(4))
+    expectedSize = width * height * 2  # width is in 16-bit units
+
+    pixelData = f.read(expectedSize)
+    if len(pixelData) < expectedSize:
+        raise ValueError("not enough image data")
+
+    pixelData = numpy.frombuffer(pixelData, dtype=numpy.uint8)
+
+    if pMode == 0:
+        # 4-bit indexed mode, 4 pixels in each 16-bit unit
+        pixels = numpy.empty(len(pixelData) * 2, dtype=numpy.uint8)
+        pixels[0::2] = pixelData & 0x0f
+        pixels[1::2] = pixelData >> 4
+        pixels = pixels.reshape(height, width * 4)
+
+    elif pMode == 1:
+        # 8-bit indexed mode, 2 pixels in each 16-bit unit
+        pixels = pixelData.reshape(height, width * 2)
+
+    elif pMode == 2:
+        # 16-bit direct mode
+        pixels = pixelData.view('<u2').astype(numpy.uint16).reshape(height, width)
+
+    else:
+        # 24-bit direct mode, 2 pixels in three 16-bit units
+        width = width * 2 // 3
+        pixels = pixelData.reshape(height, -1)[:, :width*3].reshape(height, width, 3)
+
+    return {
+        'mode': pMode,
+        'clut': clut,
+        'clut_count': clut_count,
+        'pixels': pixels,
+    }
+
+
+def decode_colors(data):
+    # Convert an array of 16-bit TIM colours to RGB
+    output = numpy.empty(data.shape + (3,), dtype=numpy.uint8)
+    output[..., 0] = COLOR_5BIT[data & 0x1f]
+    output[..., 1] = COLOR_5BIT[(data >> 5) & 0x1f]
+    output[..., 2] = COLOR_5BIT[(data >> 10) & 0x1f]
+    return output
+
+
+def get_palette(tim, clut_idx=0, disable_transparency=False, first_alpha=False):
+    # Build the 256 entry RGBA palette used for a CLUT.
+    # Black is transparent unless disable_transparency is set, in which case only the first fully
+    # zero entry is transparent. first_alpha additionally makes white entries with the STP bit set
+    # transparent in 4bpp CLUTs, which is used by name plates.
+    palette = numpy.zeros((0x100, 4), dtype=numpy.uint8)
+    palette[:, 3] = 0xff
+
+    if tim['clut'] is None:
+        return palette
+
+    palette_size = 0x100 if tim['mode'] == 1 else 0x10
+
+    clut = tim['clut']
+    if clut_idx < len(clut) // palette_size:
+        clut = clut[clut_idx*palette_size:]
+
+    if tim['mode'] == 0:
+        # The entries after the 16 used by a 4bpp CLUT are the CLUTs that follow it or white
+        clut = numpy.concatenate((clut, numpy.full(0x100, 0xffff, dtype=numpy.uint16)))
+
+    clut = clut[:0x100]
+
+    palette[:len(clut), :3] = decode_colors(clut)
+
+    transparent = (clut & 0x7fff) == 0
+    if first_alpha and tim['mode'] == 0:
+        transparent |= clut == 0xffff
+
+    if transparent.any() and not disable_transparency:
+        palette[:len(clut), 3][transparent] = 0
+
+    else:
+        transparency_idx = numpy.flatnonzero(clut == 0)
+        if len(transparency_idx) > 0:
+            palette[transparency_idx[0], 3] = 0
+
+    return palette
+
+
+def apply_palette(pixels, palette):
+    # Look up every palette index of an indexed image at once
+    return palette[pixels]
+
+
+def decode_tim(tim, clut_idx=0, disable_transparency=False, first_alpha=False):
+    # Decode parsed TIM data into an RGBA array
+    if tim['mode'] in [0, 1]:
+        return apply_palette(tim['pixels'], get_palette(tim, clut_idx, disable_transparency, first_alpha))
+
+    output = numpy.full(tim['pixels'].shape[:2] + (4,), 0xff, dtype=numpy.uint8)
+
+    if tim['mode'] == 2:
+        output[:, :, :3] = decode_colors(tim['pixels'])
+
+    else:
+        output[:, :, :3] = tim['pixels']
+
+    return output
+
+
+def read_tim_image(f, clut_idx=0, disable_transparency=False, first_alpha=False):
+    # Read TIM image from file, returning an RGBA image and the number of CLUTs in the file
+    tim = read_tim(f)
+    return Image.fromarray(decode_tim(tim, clut_idx, disable_transparency, first_alpha), "RGBA"), tim['clut_count']
@@ -69,6 +69,7 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--force-overwrite', help='Force overwrite', default=False, action="store_true")
 
     parser.add_argument('-c', '--cache-path', help='Frame cache path', default="frame_cache")
+    parser.add_argument('--video-cache-size', help='Maximum total size of videos kept memory mapped at once in MB', default=1024, type=int)
     parser.add_argument('-r', '--video-path', help='Raw video path (can specify multiple times)', default=[], action='append', nargs='+')
     parser.add_argument('-t', '--tools-path', help='Tools path', default="tools")
 
@@ -141,7 +142,10 @@ if __name__ == "__main__":
     if not os.path.exists(jpsxdec_path):
         logger.error("ERROR: Could not find jPSXdec! %s" % (jpsxdec_path))
     assert (os.path.exists(jpsxdec_path) == True)
-    frame_manager = FrameManager(args.cache_path, [os.path.abspath(x[0]) for x in args.video_path], jpsxdec_path)
+    frame_manager = FrameManager(args.cache_path, [os.path.abspath(x[0]) for x in args.video_path], jpsxdec_path, video_cache_size=args.video_cache_size * 1024 * 1024)
 
     renderer = CsqAnimationRenderer(anim_events, frame_manager, timekeeper)
     renderer.export(output_filename, song_mp3_filename, bg_image, raw_video_render_only)
+
+    stats = frame_manager.video_cache.get_stats()
+    logger.debug("Video cache: %d hits, %d misses, %d evictions, %d videos using %d/%d bytes" % (stats['hits'], stats['misses'], stats['evictions'], stats['videos'], stats['size'], stats['capacity']))
@@ -1,7 +1,7 @@
 import logging
 
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
-from moviepy.editor import concatenate_videoclips, AudioFileClip, CompositeVideoClip
+from moviepy.editor import AudioFileClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
 import numpy as np
 
@@ -19,9 +19,6 @@ class CsqAnimationRenderer:
         self.frame_manager = frame_manager
         self.timekeeper = timekeeper if timekeeper else TimeKeeper()
 
-    def get_clip(self, frames, fps):
-        return concatenate_videoclips([ImageSequenceClip(frames, fps=fps)])
-
     def get_frames(self, event):
         clip_frames = []
         frames = []
@@ -173,18 +170,60 @@ class CsqAnimationRenderer:
                 output_frames = output_frames[:expected_frame_count]
             assert(len(output_frames) == expected_frame_count)
 
-            clip = self.get_clip(output_frames, len(output_frames) / ((self.events[idx+1]['timestamp'] - event['timestamp'])/1000))
-            assert(round(clip.duration * clip.fps) == expected_frame_count)
-
+            # Only references to the cached frames are kept here, the output frames are generated while writing the video
             output_clips.append({
                 'timestamp_start': event['timestamp'],
                 'timestamp_end': self.events[idx+1]['timestamp'],
-                'clip': clip,
+                'frames': output_frames,
                 '_frame_shape': output_frames[-1].shape  # Lazy way to track the frame shape if we need to make a new blank image for the BG later
             })
 
         return output_clips
 
+    def generate_video_frames(self, output_clips, frame_count, clip_start, clip_duration, background_image=None, crossfade_time=0.5):
+        # Yields every frame of the output video in order at TARGET_FRAME_RATE.
+        # Each clip's frames are spread evenly over the clip's duration and the clips are played
+        # back to back starting at clip_start seconds, on top of the background image if there is one.
+        clip_starts = []
+        cur_start = 0
+        for c in output_clips:
+            duration = (c['timestamp_end'] - c['timestamp_start']) / 1000
+            clip_starts.append((cur_start, duration, c['frames']))
+            cur_start += duration
+
+        if background_image is not None:
+            background_frame = np.ascontiguousarray(background_image, dtype=np.uint8)
+            background_float = background_image.astype(np.float64)
+            blend_buffer = np.empty(background_image.shape, dtype=np.float64)
+            blend_buffer2 = np.empty(background_image.shape, dtype=np.float64)
+
+        clip_idx = 0
+        for frame_idx in range(frame_count):
+            t = frame_idx / TARGET_FRAME_RATE - clip_start
+
+            if t < 0 or t >= clip_duration:
+                yield background_frame
+                continue
+
+            while clip_idx + 1 < len(clip_starts) and t >= clip_starts[clip_idx + 1][0]:
+                clip_idx += 1
+
+            start, duration, frames = clip_starts[clip_idx]
+            # Small bias so frame boundaries that land exactly on an output frame don't get rounded down
+            frame = frames[min(int((t - start) * len(frames) / duration + 1e-6), len(frames) - 1)]
+
+            if background_image is None or t >= crossfade_time:
+                yield np.ascontiguousarray(frame, dtype=np.uint8)
+                continue
+
+            # Crossfade the start of the video in over the background
+            alpha = t / crossfade_time
+            np.multiply(frame, alpha, out=blend_buffer)
+            np.multiply(background_float, 1 - alpha, out=blend_buffer2)
+            blend_buffer += blend_buffer2
+
+            yield blend_buffer.astype(np.uint8)
+
     def export(self, output_filename, mp3_filename, background_image, raw_video_render_only=False):
         output_clips = self.get_output_frames()
 
@@ -195,41 +234,44 @@ class CsqAnimationRenderer:
 
         bgm_audio = AudioFileClip(mp3_filename) if mp3_filename else None
 
-        # Combine all clips into one composite clip
+        # Combine all clips into one video
         earliest_timestamp = min([c['timestamp_start'] for c in output_clips])
-        clip = concatenate_videoclips([c['clip'] for c in output_clips])
+        clip_duration = sum([(c['timestamp_end'] - c['timestamp_start']) / 1000 for c in output_clips])
 
         if clear_events:
             clear_event_timestamp = (clear_events[0] - earliest_timestamp) / 1000
 
-            if clear_event_timestamp < clip.duration:
-                clip = clip.subclip(0, clear_event_timestamp)
+            if clear_event_timestamp < clip_duration:
+                clip_duration = clear_event_timestamp
+
+        frame_shape = output_clips[-1]['_frame_shape']
+
+        if raw_video_render_only:
+            clip_start = 0
+            video_duration = clip_duration
+            background_image = None
 
-        if not raw_video_render_only:
+        else:
             video_timestamp_end = output_clips[-1]['timestamp_end'] + 1000
 
             if bgm_audio is not None and bgm_audio.duration > video_timestamp_end / 1000:
                 video_timestamp_end = bgm_audio.duration * 1000
 
-            crossfade_time = 0.5
-
             if background_image is None:
                 # Create blank background image
-                background_image = np.zeros(output_clips[-1]['_frame_shape'])
+                background_image = np.zeros(frame_shape, dtype=np.uint8)
 
             else:
                 # Resize background image if needed
-                if background_image.size != (output_clips[-1]['_frame_shape'][1], output_clips[-1]['_frame_shape'][0]):
-                    logger.warning("Expected the background image to be to %dx%d, found an image that was %dx%d. It's recommended you manually fix the background image resolution to match the video frame resolution and render again for best quality." % (output_clips[-1]['_frame_shape'][1], output_clips[-1]['_frame_shape'][0], background_image.width, background_image.height))
-                    background_image = background_image.resize((output_clips[-1]['_frame_shape'][1], output_clips[-1]['_frame_shape'][0]))
+                if background_image.size != (frame_shape[1], frame_shape[0]):
+                    logger.warning("Expected the background image to be to %dx%d, found an image that was %dx%d. It's recommended you manually fix the background image resolution to match the video frame resolution and render again for best quality." % (frame_shape[1], frame_shape[0], background_image.width, background_image.height))
+                    background_image = background_image.resize((frame_shape[1], frame_shape[0]))
 
-                background_image = np.asarray(background_image)
+                background_image = np.asarray(background_image.convert("RGB"))
 
-            # Write the background image from the very beginning to the very end of the video
-            clip = CompositeVideoClip([
-                self.get_clip([background_image] * int((video_timestamp_end/1000)*60), 60),
-                clip.set_start(earliest_timestamp / 1000).crossfadein(crossfade_time)
-            ])
+            # The background image is shown from the very beginning to the very end of the video
+            clip_start = earliest_timestamp / 1000
+            video_duration = max(int((video_timestamp_end / 1000) * TARGET_FRAME_RATE) / TARGET_FRAME_RATE, clip_start + clip_duration)
 
         # Just some quick checks to make sure there are no unexpected gaps in the video frames
         # If this ever asserts then there's probably an issue with the parser somewhere
@@ -240,8 +282,19 @@ class CsqAnimationRenderer:
                 logger.error("ERROR: Found gap in video clips! %f to %f" % (timestamps[i+1][1], timestamp[0]))
             assert (timestamp[0] <= timestamps[i+1][1])
 
-        if not raw_video_render_only and bgm_audio is not None:
-            clip = clip.set_audio(bgm_audio)
+        audio_filename = mp3_filename if not raw_video_render_only and bgm_audio is not None else None
+        if bgm_audio is not None:
+            bgm_audio.close()
+
+        # Frames are generated one at a time and piped straight into ffmpeg so memory usage doesn't depend on the song length
+        writer = FFMPEG_VideoWriter(output_filename, (frame_shape[1], frame_shape[0]), TARGET_FRAME_RATE,
+                                    codec="libx264", preset="ultrafast", bitrate="50000k", audiofile=audio_filename,
+                                    ffmpeg_params=["-acodec", "aac"] if audio_filename is not None else None)
+
+        try:
+            frame_count = int(video_duration * TARGET_FRAME_RATE)
+            for frame in self.generate_video_frames(output_clips, frame_count, clip_start, clip_duration, background_image):
+                writer.write_frame(frame)
 
-        clip.write_videofile(output_filename, audio_codec="aac", preset="ultrafast",
-                             fps=TARGET_FRAME_RATE, bitrate="50000k")
+        finally:
+            writer.close()
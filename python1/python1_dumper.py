@@ -3,6 +3,11 @@ import ctypes
 import os
 import string
 import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from gcz import decompress_gcz
 
 def get_filename_hash(filename):
     hash = 0
@@ -74,43 +79,6 @@ def decrypt_data(data):
         return data
 
 
-def decompress_gcz(data):
-    data_length = len(data)
-    offset = 0
-    output = []
-
-    while offset < data_length:
-        flag = data[offset]
-        offset += 1
-
-        for bit in range(8):
-            if flag & (1 << bit):
-                output.append(data[offset])
-                offset += 1
-
-            else:
-                if offset + 2 > data_length:
-                    break
-
-                cmd1, cmd2 = data[offset:offset+2]
-                lookback_length = (cmd1 & 0x0f) + 3
-                lookback_offset = ((cmd1 & 0xf0) << 4) + cmd2
-                offset += 2
-
-                if cmd1 == 0 and cmd2 == 0:
-                    break
-
-                for _ in range(lookback_length):
-                    loffset = len(output) - lookback_offset
-                    if loffset <= 0 or loffset >= len(output):
-                        output.append(0)
-
-                    else:
-                        output.append(output[loffset])
-
-    return bytearray(output)
-
-
 def get_file_data(infile, fileinfo):
     cur_offset = infile.tell()
 
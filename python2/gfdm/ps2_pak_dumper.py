@@ -1,16 +1,73 @@
 import argparse
+import binascii
+import collections
+import concurrent.futures
 import glob
 import hashlib
 import itertools
+import json
+import mmap
 import os
 import struct
+import zlib
 
 from ctypes import c_ulong
 
+BIT_REVERSE_TABLE = bytes([int("{:08b}".format(i)[::-1], 2) for i in range(256)])
+BIT_REVERSE_TRANSLATION = bytes.maketrans(bytes(range(256)), BIT_REVERSE_TABLE)
+
+class PackReader:
+    def __init__(self, max_open=16):
+        # Keep a small LRU of memory-mapped packs so each pack is only opened once
+        # while extracting entries in (packid, offset) order
+        self.max_open = max_open
+        self.packs = collections.OrderedDict()
+
+
+    def open_pack(self, packpath):
+        if packpath in self.packs:
+            self.packs.move_to_end(packpath)
+            return self.packs[packpath]
+
+        with open(packpath, "rb") as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                pack = memoryview(b"")
+
+            else:
+                pack = memoryview(mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ))
+
+        self.packs[packpath] = pack
+
+        while len(self.packs) > self.max_open:
+            # The mmap is released once the last slice referencing it goes away
+            self.packs.popitem(last=False)
+
+        return pack
+
+
+    def read(self, packpath, offset, size):
+        return self.open_pack(packpath)[offset:offset+size]
+
+
+    def close(self):
+        self.packs.clear()
+
+
+    def __getstate__(self):
+        # Mapped packs can't be sent to worker processes, they get reopened there instead
+        return { 'max_open': self.max_open }
+
+
+    def __setstate__(self, state):
+        self.__init__(state['max_open'])
+
+
 class PakDumper:
     def __init__(self, packinfo, demux, fast):
         self.entries = self.parse_pack_data(packinfo)
+        self.packinfo_md5 = hashlib.md5(open(packinfo, "rb").read()).hexdigest()
         self.packlist = self.generate_packlist()
+        self.pack_reader = PackReader()
         self.crc32_tab = self.generate_crc32_table()
         self.demux = demux
         self.fast = fast
@@ -33,14 +90,18 @@ class PakDumper:
         return crc32_tab
 
 
-    def calculate_filename_hash(self, input):
+    def normalize_filename(self, input):
         if input.startswith("data/"):
             input = "/" + input
 
         if input.startswith("/data/aep"):
             input = input.lower()
 
-        input = bytearray(input, 'ascii')
+        return input
+
+
+    def calculate_filename_hash(self, input):
+        input = bytearray(self.normalize_filename(input), 'ascii')
 
         crc32_sum = 0xffffffff
         for i in range(len(input)):
@@ -137,6 +198,75 @@ class PakDumper:
         return checksum & 0xffff
 
 
+    def calculate_filename_hashes(self, filenames):
+        # Batched version of calculate_filename_hash, calculate_filename_hash_crc16 and
+        # calculate_filename_hash_crc16_cs that uses the C implementations from zlib and binascii.
+        # The reflected CRC16 is calculated as a normal CRC16 over bit reversed input.
+        hashes = []
+
+        for filename in filenames:
+            data = filename.encode('ascii')
+            crc16 = binascii.crc_hqx(data.translate(BIT_REVERSE_TRANSLATION), 0xffff)
+            crc16 = (BIT_REVERSE_TABLE[crc16 & 0xff] << 8) | BIT_REVERSE_TABLE[crc16 >> 8]
+
+            hashes.append((
+                zlib.crc32(self.normalize_filename(filename).encode('ascii')),
+                ~crc16 & 0xffff,
+                binascii.crc_hqx(data, 0),
+            ))
+
+        return hashes
+
+
+    def find_existing_files(self, filenames):
+        found = []
+
+        for filename in filenames:
+            # The CRC32 alone rejects almost every candidate so only calculate the CRC16s on a hit
+            entry = self.entries.get(zlib.crc32(self.normalize_filename(filename).encode('ascii')))
+
+            if entry is None:
+                continue
+
+            _, filename_hash_crc16, filename_hash_crc16_2 = self.calculate_filename_hashes([filename])[0]
+
+            if entry['key2'] in [filename_hash_crc16, filename_hash_crc16_2]:
+                entry['orig_filename'] = filename
+                found.append(filename)
+
+        return found
+
+
+    def load_filename_index(self, path, songs):
+        index_path = os.path.join(path, "%s.json" % self.packinfo_md5)
+
+        if not os.path.exists(index_path):
+            return False
+
+        index = json.load(open(index_path))
+
+        if songs and not index['songs']:
+            # The cached index was created without the song filename bruteforce
+            return False
+
+        for k, filename in index['filenames'].items():
+            if int(k, 16) in self.entries:
+                self.entries[int(k, 16)]['orig_filename'] = filename
+
+        return True
+
+
+    def save_filename_index(self, path, songs):
+        os.makedirs(path, exist_ok=True)
+
+        index = {
+            'songs': songs,
+            'filenames': { "%08x" % k: self.entries[k]['orig_filename'] for k in self.entries if 'orig_filename' in self.entries[k] },
+        }
+
+        json.dump(index, open(os.path.join(path, "%s.json" % self.packinfo_md5), "w"), indent=4)
+
+
     def parse_pack_data(self, filename):
         entries = {}
 
@@ -197,12 +327,87 @@ class PakDumper:
         return (val << r_bits) & 0xFFFFFFFF | ((val & 0xFFFFFFFF) >> (32 - r_bits))
 
 
+    def decrypt_numpy(self, data, key1, key2, block_size=0x10000):
+        import numpy as np
+
+        # Every key is rol(key + key2, 3). Rotating left by 3 is the same as multiplying by 8 modulo
+        # 2^32 - 1, so as long as key + key2 doesn't carry out of 32 bits the n-th key after key is
+        # rol(key, 3n) + sum(rol(key2, 3j) for j in 1..n) modulo 2^32 - 1, which can be generated for a
+        # whole block at once. The block is only used up to the first carry or ambiguous key (0 and
+        # 0xffffffff are the same modulo 2^32 - 1), after which keys are generated one at a time for
+        # a while. Some keys carry every few dozen steps, so that stretch doubles every time the next
+        # block fails again.
+        words = np.frombuffer(data, dtype='<u4', count=len(data) // 4)
+        mod = np.uint64(0xffffffff)
+
+        rotations = (np.arange(1, min(block_size, len(words)) + 1, dtype=np.uint64) * np.uint64(3)) % np.uint64(32)
+        inverse_rotations = np.uint64(32) - rotations
+        key2_sums = np.cumsum(((np.uint64(key2) << rotations) | (np.uint64(key2) >> inverse_rotations)) & mod) % mod
+
+        key = key1
+        i = 0
+        run = block_size
+        slow_run = min(0x100, block_size)
+        while i < len(words):
+            count = min(run, len(words) - i)
+
+            prev_key = np.uint64(key)
+            keys = ((((prev_key << rotations[:count]) | (prev_key >> inverse_rotations[:count])) & mod) + key2_sums[:count]) % mod
+
+            prev_keys = np.concatenate(([prev_key], keys[:-1]))
+            invalid = np.flatnonzero((prev_keys >= 0x100000000 - key2) | (keys == 0))
+
+            if len(invalid) == 0:
+                words[i:i+count] ^= keys.astype(np.uint32)
+                key = int(keys[-1])
+                i += count
+                run = min(run * 2, block_size)
+                slow_run = min(0x100, block_size)
+                continue
+
+            count = int(invalid[0])
+            words[i:i+count] ^= keys[:count].astype(np.uint32)
+            key = int(prev_keys[count])
+            i += count
+
+            count = min(slow_run, len(words) - i)
+            keystream = []
+            for _ in range(count):
+                key = (key + key2) & 0xffffffff
+                key = ((key << 3) | (key >> 29)) & 0xffffffff
+                keystream.append(key)
+
+            words[i:i+count] ^= np.array(keystream, dtype=np.uint32)
+            i += count
+            run = min(0x100, block_size)
+            slow_run = min(slow_run * 2, block_size)
+
+        # Match the tail handling of the Cython module
+        i = len(words) * 4
+        key = self.rol((key + key2) & 0xffffffff, 3)
+        parts = [key & 0xff, (key >> 8) & 0xff, (key >> 16) & 0xff, (key >> 24) & 0xff]
+        for j in range(len(data) - i):
+            data[i] ^= parts[j]
+
+        return data
+
+
     def decrypt(self, data, key1, key2):
         if self.fast:
-            # Uses a Cython module for fast decryption
-            import pakdec
-            pakdec.decrypt(data, len(data), key1, key2)
-            return data
+            # Use the fastest backend available: the Cython module if it was built, otherwise NumPy
+            try:
+                import pakdec
+                pakdec.decrypt(data, len(data), key1, key2)
+                return data
+
+            except ImportError:
+                pass
+
+            try:
+                return self.decrypt_numpy(data, key1, key2)
+
+            except ImportError:
+                pass
 
         key = key1
 
@@ -225,15 +430,7 @@ class PakDumper:
 
 
     def file_exists(self, input):
-        filename_hash = self.calculate_filename_hash(input)
-        filename_hash_crc16 = self.calculate_filename_hash_crc16(input)
-        filename_hash_crc16_2 = self.calculate_filename_hash_crc16_cs(input)
-        exists = filename_hash in self.entries and self.entries[filename_hash]['key2'] in [filename_hash_crc16, filename_hash_crc16_2]
-
-        if exists:
-            self.entries[filename_hash]['orig_filename'] = input
-
-        return exists
+        return len(self.find_existing_files([input])) > 0
 
 
     def get_md5sum(self, data):
@@ -266,22 +463,20 @@ class PakDumper:
             print("Could not find %s" % packpath)
             return None
 
-        data = bytearray(open(packpath, "rb").read()[entry['offset']:entry['offset']+entry['filesize']])
+        # Zero-copy view into the mapped pack, only copied when it has to be decrypted
+        data = self.pack_reader.read(packpath, entry['offset'], entry['filesize'])
 
         encryption = False
         if self.get_md5sum(data) != entry['md5sum']:
             encryption = True
 
         if encryption:
-            decrypted = self.decrypt(data, entry['key1'], entry['key2'])
-
-        else:
-            decrypted = data
+            data = self.decrypt(bytearray(data), entry['key1'], entry['key2'])
 
         if self.get_md5sum(data) != entry['md5sum']:
             print("Bad checksum for", path)
 
-        return decrypted
+        return data
 
 
     def extract_data(self, path, input_path, output_path):
@@ -292,14 +487,19 @@ class PakDumper:
 
         output_path = os.path.join(output_path, path)
 
-        if not os.path.exists(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
         open(output_path, "wb").write(data)
 
         if self.demux and os.path.splitext(output_path)[1].lower() == ".pss":
-            from pss_demux import demux_pss
-            demux_pss(output_path, os.path.dirname(output_path))
+            # Demux straight from the decrypted data instead of reading the .pss back in
+            from pss_demux import demux_pss_data
+
+            try:
+                demux_pss_data(data, os.path.splitext(os.path.basename(output_path))[0], os.path.dirname(output_path))
+
+            except ValueError as e:
+                print("Couldn't demux %s: %s" % (output_path, e))
 
         return True
 
@@ -2188,9 +2388,7 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
                 path = "/data/product/music/system/%s%s.%s" % (system_audio_part, game, ext)
                 possible_filenames.append(path)
 
-    for path in possible_filenames:
-        if dumper.file_exists(path):
-            filenames.append(path)
+    filenames += dumper.find_existing_files(possible_filenames)
 
     filenames = list(set(filenames))
 
@@ -2198,6 +2396,8 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
         data = dumper.extract_data_mem("/data/product/d3/package/packlist.bin", input_path=input_path)
 
         if data:
+            data = bytes(data)
+
             if data[:4] == b"TSLF":
                 offset = int.from_bytes(data[0x14:0x18], 'little')
                 first_offset = int.from_bytes(data[offset:offset+4], 'little')
@@ -2219,6 +2419,8 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
         data = dumper.extract_data_mem("/data/product/aep/gf_aep_list.bin", input_path=input_path)
 
         if data:
+            data = bytes(data)
+
             for offset in range(0, len(data), 0x20):
                 string = data[offset:offset+data[offset:].index(b'\0')].decode('ascii').strip('\0')
                 path = "/data/product/aep/%s.bin" % (string)
@@ -2295,16 +2497,12 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
                 templates.append("/data/product/music/m%04d/b%04d" + t + "." + ext)
 
         for i in range(0, 9999):
-            for template in templates:
-                path = template % tuple(i for _ in range(template.count("%04d")))
-
-                if dumper.file_exists(path):
-                    filenames.append(path)
+            paths = [template % tuple(i for _ in range(template.count("%04d"))) for template in templates]
 
             for j in range(0, 10):
-                for path in ["/data/product/music/m%04d/dm_lesson%01d.va2" % (i, j), "/data/product/music/m%04d/gt_lesson%01d.va2" % (i, j)]:
-                    if dumper.file_exists(path):
-                        filenames.append(path)
+                paths += ["/data/product/music/m%04d/dm_lesson%01d.va2" % (i, j), "/data/product/music/m%04d/gt_lesson%01d.va2" % (i, j)]
+
+            filenames += dumper.find_existing_files(paths)
 
     templates = [
         "/data/product/aep/gf_int_%03d.bin",
@@ -2314,12 +2512,8 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
         "/data/product/aep/gf_int_%03d.bin",
     ]
 
-    for i in range(0, 1000):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%03d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+    paths = [template % tuple(i for _ in range(template.count("%03d"))) for i in range(0, 1000) for template in templates]
+    filenames += dumper.find_existing_files(paths)
 
     templates = [
         "/data/product/d3/model/mdl_gf_idx_image_%02d.bin",
@@ -2368,12 +2562,8 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
         "/data/product/aep/sp_ggm_eflane%02d.bin",
     ]
 
-    for i in range(0, 100):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%02d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+    paths = [template % tuple(i for _ in range(template.count("%02d"))) for i in range(0, 100) for template in templates]
+    filenames += dumper.find_existing_files(paths)
 
     templates = [
         "/data/product/d3/model/mdl_gf_game%01d.bin",
@@ -2385,12 +2575,8 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
         "/data/product/d3/model/tex_gf_battle_common%01d.bin",
     ]
 
-    for i in range(0, 10):
-        for template in templates:
-            path = template % tuple(i for _ in range(template.count("%01d")))
-
-            if dumper.file_exists(path):
-                filenames.append(path)
+    paths = [template % tuple(i for _ in range(template.count("%01d"))) for i in range(0, 10) for template in templates]
+    filenames += dumper.find_existing_files(paths)
 
     for i in range(0, 100):
         for j in range(0, 100):
@@ -2404,9 +2590,7 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
                     "/data/product/music/system/dmxg%d_v%02d.%s" % (i, j, ext),
                 ]
 
-                for path in paths:
-                    if dumper.file_exists(path):
-                        filenames.append(path)
+                filenames += dumper.find_existing_files(paths)
 
         for ext in ['va2', 'va3']:
             paths = [
@@ -2478,6 +2662,55 @@ def bruteforce_filenames(dumper, input_path="", do_bruteforce_songs=False):
     return filenames
 
 
+def extract_entries(dumper, keys, input_path, output_path):
+    named = 0
+
+    for k in keys:
+        if 'orig_filename' in dumper.entries[k]:
+            print("%-64s packid[%04d] offset[%08x] filesize[%08x] hash[%08x]" % (dumper.entries[k]['orig_filename'], dumper.entries[k]['packid'], dumper.entries[k]['offset'], dumper.entries[k]['filesize'], k))
+            dumper.extract_data(dumper.entries[k]['orig_filename'], input_path, output_path)
+            named += 1
+
+        else:
+            # print("Dumping %08x.bin" % k)
+
+            data = dumper.extract_data_mem(None, input_path, k)
+
+            unknown_path = os.path.join(output_path, "unknown")
+            os.makedirs(unknown_path, exist_ok=True)
+
+            output_filename = os.path.join(unknown_path, "%08x.bin" % k)
+            print("Dumping", output_filename)
+            open(output_filename, "wb").write(data)
+
+    dumper.pack_reader.close()
+
+    return named
+
+
+worker_dumper = None
+
+def init_extract_worker(dumper):
+    global worker_dumper
+    worker_dumper = dumper
+
+
+def extract_entries_worker(keys, input_path, output_path):
+    return extract_entries(worker_dumper, keys, input_path, output_path)
+
+
+def extract_entries_parallel(dumper, keys, input_path, output_path, jobs):
+    # Entries are independent once packinfo.bin is parsed, so shard them by pack.
+    # Each worker reads, decrypts, verifies and writes the entries of the packs it was given.
+    packs = collections.OrderedDict()
+    for k in keys:
+        packs.setdefault(dumper.entries[k]['packid'], []).append(k)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_extract_worker, initargs=(dumper,)) as executor:
+        futures = [executor.submit(extract_entries_worker, pack_keys, input_path, output_path) for pack_keys in packs.values()]
+        return sum(future.result() for future in futures)
+
+
 def find_packinfo(path):
     packinfo_paths = glob.glob(os.path.join(path, "**", "packinfo.bin"), recursive=True)
 
@@ -2495,7 +2728,9 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', help='Output folder (optional)', default="output")
     parser.add_argument('-d', '--demux', help='Demux PSS files', default=False, action="store_true")
     parser.add_argument('-s', '--skip-songs', help='Skip GFDM music filename bruteforce', default=False, action="store_true")
-    parser.add_argument('-f', '--fast', help='Use Cython decryption code', default=False, action="store_true")
+    parser.add_argument('-f', '--fast', help='Use Cython or NumPy decryption code', default=False, action="store_true")
+    parser.add_argument('-j', '--jobs', help='Number of worker processes used for extraction', default=1, type=int)
+    parser.add_argument('-c', '--index-cache', help='Folder used to cache bruteforced filenames per packinfo.bin (optional)', default=None)
 
     args = parser.parse_args()
 
@@ -2507,29 +2742,20 @@ if __name__ == "__main__":
 
     dumper = PakDumper(packinfo_path, args.demux, args.fast)
 
-    filenames = bruteforce_filenames(dumper, args.input, do_bruteforce_songs=args.skip_songs == False)
-
-    sorted_keys = sorted(dumper.entries, key=lambda x:(dumper.entries[x].get('packid', 0), dumper.entries[x].get('offset', 0)))
-
-    named = 0
-
-    for k in sorted_keys:
-        if 'orig_filename' in dumper.entries[k]:
-            print("%-64s packid[%04d] offset[%08x] filesize[%08x] hash[%08x]" % (dumper.entries[k]['orig_filename'], dumper.entries[k]['packid'], dumper.entries[k]['offset'], dumper.entries[k]['filesize'], k))
-            dumper.extract_data(dumper.entries[k]['orig_filename'], args.input, args.output)
-            named += 1
+    if args.index_cache is None:
+        bruteforce_filenames(dumper, args.input, do_bruteforce_songs=args.skip_songs == False)
 
-        else:
-            # print("Dumping %08x.bin" % k)
+    elif not dumper.load_filename_index(args.index_cache, songs=args.skip_songs == False):
+        bruteforce_filenames(dumper, args.input, do_bruteforce_songs=args.skip_songs == False)
+        dumper.save_filename_index(args.index_cache, songs=args.skip_songs == False)
 
-            data = dumper.extract_data_mem(None, args.input, k)
+    sorted_keys = sorted(dumper.entries, key=lambda x:(dumper.entries[x].get('packid', 0), dumper.entries[x].get('offset', 0)))
 
-            output_path = os.path.join(args.output, "unknown")
-            os.makedirs(output_path, exist_ok=True)
+    if args.jobs > 1:
+        named = extract_entries_parallel(dumper, sorted_keys, args.input, args.output, args.jobs)
 
-            output_filename = os.path.join(output_path, "%08x.bin" % k)
-            print("Dumping", output_filename)
-            open(output_filename, "wb").write(data)
+    else:
+        named = extract_entries(dumper, sorted_keys, args.input, args.output)
 
     print("Named: %d" % (named))
     print("Unnamed: %d" % (len(sorted_keys) - named))
@@ -1,56 +1,58 @@
 import argparse
+import mmap
 import os
 import sys
 
-def demux_pss(input_filename, output_folder):
-    base_filename = os.path.splitext(os.path.basename(input_filename))[0]
-
+def demux_pss_data(data, base_filename, output_folder):
+    # Demuxes directly from any buffer (bytes, bytearray, mmap) using memoryview slices
+    # so packet payloads are written out without being copied.
+    # Raises ValueError if the data can't be demuxed.
     if output_folder and not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    with open(input_filename, "rb") as infile:
-        data = bytearray(infile.read())
+    idx = 0
 
-        idx = 0
+    video_output = open(os.path.join(output_folder, "%s.m2v" % base_filename), "wb")
+    audio_outputs = {}
 
-        video_output = open(os.path.join(output_folder, "%s.m2v" % base_filename), "wb")
-        audio_outputs = {}
+    # The view is released even if demuxing fails so the caller can close the buffer (mmap) it was made from
+    data = memoryview(data)
 
+    try:
         while True:
-            header = data[idx:idx+4]
+            header = bytes(data[idx:idx+4])
             idx += 4
 
-            if header == bytearray([0x00, 0x00, 0x01, 0xba]):
+            if header == b"\x00\x00\x01\xba":
                 # MPEG start
                 idx += 0x0a
 
-            elif header == bytearray([0x00, 0x00, 0x01, 0xb9]):
+            elif header == b"\x00\x00\x01\xb9":
                 # MPEG end
                 break
 
-            elif header == bytearray([0x00, 0x00, 0x01, 0xbb]):
+            elif header == b"\x00\x00\x01\xbb":
                 # Not sure
                 idx += int.from_bytes(data[idx:idx+2], byteorder="big") + 2
 
-            elif header == bytearray([0x00, 0x00, 0x01, 0xbe]):
+            elif header == b"\x00\x00\x01\xbe":
                 # Audio?
                 idx += int.from_bytes(data[idx:idx+2], byteorder="big") + 2
 
-            elif header[:3] == bytearray([0x00, 0x00, 0x01]):
+            elif header[:3] == b"\x00\x00\x01":
                 if header[3] >= 0xbd and header[3] <= 0xdf and header[3] != 0xbe:
                     streamType = (data[idx+0x10] + data[idx+0x12]) & 0xf0
                     streamId = (data[idx+0x10] + data[idx+0x12]) & 0x0f
 
                     if streamType != 0x90:
-                        print("Found unexpected audio stream type @ %08x" % (idx - 4))
-                        exit(1)
+                        raise ValueError("Found unexpected audio stream type @ %08x" % (idx - 4))
 
                     if streamId not in audio_outputs:
                         part = ["___k", "__bk", "_gbk", "d__k", "d_bk"][streamId - 1]
                         audio_outputs[streamId] = open(os.path.join(output_folder, "%s%s.at3" % (base_filename, part)), "wb")
 
                     dataLen = int.from_bytes(data[idx:idx+2], byteorder="big")
-                    headerOffset = int.from_bytes(data[idx+4:idx+5], byteorder="little")
+                    headerOffset = data[idx+4]
                     dataLen -= headerOffset + 7
                     idx += headerOffset + 9
 
@@ -59,7 +61,7 @@ def demux_pss(input_filename, output_folder):
 
                 elif header[3] >= 0xe0 and header[3] <= 0xef:
                     dataLen = int.from_bytes(data[idx:idx+2], byteorder="big")
-                    headerOffset = int.from_bytes(data[idx+4:idx+5], byteorder="little")
+                    headerOffset = data[idx+4]
                     dataLen -= headerOffset + 3
                     idx += headerOffset + 5
 
@@ -67,15 +69,34 @@ def demux_pss(input_filename, output_folder):
                     idx += dataLen
 
                 else:
-                    exit(1)
+                    raise ValueError("Found unexpected stream @ %08x" % (idx - 4))
 
             else:
-                exit(1)
+                raise ValueError("Found unexpected data @ %08x" % (idx - 4))
+
+    except IndexError:
+        raise ValueError("Found truncated packet @ %08x" % idx) from None
+
+    finally:
+        data.release()
+
+        for k in audio_outputs:
+            audio_outputs[k].close()
 
-    for k in audio_outputs:
-        audio_outputs[k].close()
+        video_output.close()
+
+
+def demux_pss(input_filename, output_folder):
+    base_filename = os.path.splitext(os.path.basename(input_filename))[0]
+
+    with open(input_filename, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            demux_pss_data(b"", base_filename, output_folder)
+            return
 
-    video_output.close()
+        # Memory map the input so only the pages currently being demuxed need to be resident
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            demux_pss_data(data, base_filename, output_folder)
 
 
 if __name__ == "__main__":
@@ -85,5 +106,9 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    demux_pss(args.input, args.output)
+    try:
+        demux_pss(args.input, args.output)
 
+    except ValueError as e:
+        print(e)
+        exit(1)
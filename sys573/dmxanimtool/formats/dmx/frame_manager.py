@@ -1,92 +1,195 @@
+import collections
 import logging
 import os
-import shutil
+import subprocess
+import sys
 import tempfile
 
 from PIL import Image
 
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..", "common"))
+
+import mdec
+
 logger = logging.getLogger("dmxanimtool." + __name__)
 
 
-class FrameManager:
-    def __init__(self, cache_folder, raw_video_folders=[], jpsxdec_jar_path=None):
-        self.video_cache = {}
-        self.frame_cache = {}
-        self.cache_folder = os.path.abspath(cache_folder)
-        self.raw_video_folders = raw_video_folders
-        self.jpsxdec_jar_path = os.path.abspath(jpsxdec_jar_path) if jpsxdec_jar_path is not None else None
+class VideoCache:
+    # LRU cache of memory mapped videos that is limited by the total size of their frames in bytes.
+    # This limits how much video is mapped at once, not resident memory: frames are only read from disk
+    # when they are used, the OS can drop those pages again, and frames that were already handed out
+    # keep their video mapped after it is evicted.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.videos = collections.OrderedDict()
 
-        self.temp_dir = os.path.abspath(tempfile._get_default_tempdir())
-        os.makedirs(self.temp_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def dump_raw_frame(self, chunk, output_filename):
-        JPSXDEC_COMMAND = "java -jar \"%s\" -f \"{0}\" -static bs -dim {1}x{2} -fmt png -quality psx" % self.jpsxdec_jar_path
+    def get(self, filename):
+        frames = self.videos.get(filename, None)
 
-        # This is stupid but jPSXdec doesn't actually have a way to save to a specific directory from command line,
-        # so change directories to the temporary folder until the end of the function and then restore the old directory
-        cwd = os.getcwd()
+        if frames is None:
+            self.misses += 1
+            return None
 
-        # Windows doesn't like
-        temp_filename = os.path.join(self.temp_dir, next(tempfile._get_candidate_names())) + ".bin"
-        with open(temp_filename, "wb") as raw_frame_file:
-            raw_frame_file.write(chunk)
+        self.hits += 1
+        self.videos.move_to_end(filename)
 
-        os.chdir(os.path.dirname(temp_filename))
+        return frames
 
-        converted_frame_path = os.path.splitext(temp_filename)[0] + ".png"
+    def put(self, filename, frames):
+        if filename in self.videos:
+            self.size -= self.videos.pop(filename).nbytes
 
-        cmd = JPSXDEC_COMMAND.format(os.path.basename(temp_filename), 320, 180)
-        os.system(cmd)
+        self.videos[filename] = frames
+        self.size += frames.nbytes
 
-        shutil.move(converted_frame_path, output_filename)
+        # The video that was just added is always kept even if it's bigger than the cache by itself
+        while self.size > self.capacity and len(self.videos) > 1:
+            _, evicted_frames = self.videos.popitem(last=False)
+            self.size -= evicted_frames.nbytes
+            self.evictions += 1
 
-        if os.path.exists(temp_filename):
-            os.unlink(temp_filename)
+    def get_stats(self):
+        return {
+            'videos': len(self.videos),
+            'size': self.size,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
 
-        os.chdir(cwd)
 
-    def get_cached_frames(self, filename):
-        self.video_cache[filename] = []
+# Every frame of a video is a bitstream frame padded to a fixed size
+FRAME_SIZE = 0x3000
+FRAME_WIDTH = 320
+FRAME_HEIGHT = 180
+
+
+class FrameManager:
+    def __init__(self, cache_folder, raw_video_folders=[], jpsxdec_jar_path=None, video_cache_size=0x40000000):
+        self.video_cache = VideoCache(video_cache_size)
+        self.cache_folder = os.path.abspath(cache_folder)
+        self.raw_video_folders = raw_video_folders
+        self.jpsxdec_jar_path = os.path.abspath(jpsxdec_jar_path) if jpsxdec_jar_path is not None else None
 
+    def dump_raw_frame_jpsxdec(self, chunk):
+        # jPSXdec always saves next to the input file, so the frame is written into a private temporary
+        # folder which is used as the working directory of the jPSXdec process
+        assert (self.jpsxdec_jar_path is not None)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_filename = os.path.join(temp_dir, "frame.bin")
+            with open(temp_filename, "wb") as raw_frame_file:
+                raw_frame_file.write(chunk)
+
+            cmd = [
+                "java", "-jar", self.jpsxdec_jar_path,
+                "-f", os.path.basename(temp_filename),
+                "-static", "bs",
+                "-dim", "%dx%d" % (FRAME_WIDTH, FRAME_HEIGHT),
+                "-fmt", "png",
+                "-quality", "psx",
+            ]
+            try:
+                subprocess.run(cmd, cwd=temp_dir, stdout=subprocess.DEVNULL)
+
+            except OSError as e:
+                logger.error("Could not run jPSXdec: %s" % e)
+
+            converted_frame_path = os.path.splitext(temp_filename)[0] + ".png"
+            if not os.path.exists(converted_frame_path):
+                # Keep the frame indexes of the video intact with a blank frame
+                logger.error("jPSXdec could not convert frame")
+                return np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8)
+
+            with Image.open(converted_frame_path) as inframe:
+                return np.asarray(inframe.convert("RGB"))
+
+    def dump_raw_frames(self, chunks):
+        # Frames are decoded in Python, jPSXdec is only started for frames the decoder can't handle
+        frames = []
+        for frame_idx, chunk in enumerate(chunks):
+            try:
+                frames.append(mdec.decode_bs_image(chunk, FRAME_WIDTH, FRAME_HEIGHT))
+
+            except ValueError as e:
+                logger.debug("Using jPSXdec for frame %d: %s" % (frame_idx, e))
+                frames.append(self.dump_raw_frame_jpsxdec(chunk))
+
+        return frames
+
+    def get_cache_filename(self, filename):
+        return os.path.join(self.cache_folder, "%s.npy" % os.path.basename(os.path.splitext(filename)[0]))
+
+    def get_frame_filenames(self, filename, frame_count=None):
+        # Individual frames of caches made by older versions
         basename = os.path.basename(os.path.splitext(filename)[0])
-        frame_idx = 0
+        output_filenames = []
 
-        while True:
-            output_filename = os.path.join(self.cache_folder, "%s_%04d.png" % (basename, frame_idx))
+        while frame_count is None or len(output_filenames) < frame_count:
+            output_filename = os.path.join(self.cache_folder, "%s_%04d.png" % (basename, len(output_filenames)))
 
-            if not os.path.exists(output_filename):
+            if frame_count is None and not os.path.exists(output_filename):
                 break
 
-            with Image.open(output_filename) as inframe:
-                self.frame_cache[output_filename] = (inframe.tobytes(), inframe.size, inframe.mode)
+            output_filenames.append(output_filename)
 
-                self.video_cache[filename].append(
-                    np.asarray(Image.frombytes(
-                        mode=self.frame_cache[output_filename][2],
-                        size=self.frame_cache[output_filename][1],
-                        data=self.frame_cache[output_filename][0]
-                    ))
-                )
+        return output_filenames
 
-            frame_idx += 1
+    def save_frames(self, filename, frames):
+        # Store all frames of a video as a single (frames, height, width, channels) uint8 array
+        # so it can be memory mapped when loading instead of decoding the video again
+        cache_filename = self.get_cache_filename(filename)
+        temp_filename = cache_filename + ".tmp"
 
+        with open(temp_filename, "wb") as outfile:
+            np.save(outfile, np.stack(frames))
+
+        os.replace(temp_filename, cache_filename)
+
+    def pack_frames(self, filename, frame_filenames):
+        frames = []
+        for frame_filename in frame_filenames:
+            with Image.open(frame_filename) as inframe:
+                frames.append(np.asarray(inframe))
+
+        self.save_frames(filename, frames)
+
+        for frame_filename in frame_filenames:
+            os.unlink(frame_filename)
+
+    def get_cached_frames(self, filename):
+        cache_filename = self.get_cache_filename(filename)
+
+        if not os.path.exists(cache_filename):
+            # Convert caches made by older versions that stored every frame as a PNG
+            frame_filenames = self.get_frame_filenames(filename)
+
+            if not frame_filenames:
+                return None
+
+            self.pack_frames(filename, frame_filenames)
+
+        return np.load(cache_filename, mmap_mode='r')
 
     def get_raw_frames(self, filename, ext):
         req_frames = []
 
         os.makedirs(self.cache_folder, exist_ok=True)
 
-        if not filename in self.video_cache:
-            self.get_cached_frames(filename)
-
-        if not self.video_cache.get(filename, []):
-            # Only deal with jPSXdec if we need to dump a video
-            assert (self.jpsxdec_jar_path is not None)
+        frames = self.video_cache.get(filename)
 
-            self.video_cache[filename] = []
+        if frames is None:
+            frames = self.get_cached_frames(filename)
 
+        if frames is None:
             input_filename = None
             for raw_video_folder in self.raw_video_folders:
                 for xt in [ext.lower(), ext.upper()]:
@@ -105,28 +208,18 @@ class FrameManager:
             logger.debug("Loading frames for %s" % input_filename)
 
             with open(input_filename, "rb") as infile:
-                data = bytearray(infile.read())
-                chunks = [data[i:i+0x3000] for i in range(0, len(data), 0x3000)]
-
-                for frame_idx in range(len(chunks)):
-                    output_filename = os.path.join(self.cache_folder, "%s_%04d.png" % (
-                        os.path.basename(os.path.splitext(filename)[0]), frame_idx))
+                data = infile.read()
+                chunks = [data[i:i+FRAME_SIZE] for i in range(0, len(data), FRAME_SIZE)]
 
-                    if output_filename not in self.frame_cache:
-                        if not os.path.exists(output_filename):
-                            self.dump_raw_frame(chunks[frame_idx], output_filename)
+            if not chunks:
+                return req_frames
 
-                        with Image.open(output_filename) as inframe:
-                            self.frame_cache[output_filename] = (inframe.tobytes(), inframe.size, inframe.mode)
+            self.save_frames(filename, self.dump_raw_frames(chunks))
+            frames = np.load(self.get_cache_filename(filename), mmap_mode='r')
 
-                    self.video_cache[filename].append(
-                        np.asarray(Image.frombytes(
-                            mode=self.frame_cache[output_filename][2],
-                            size=self.frame_cache[output_filename][1],
-                            data=self.frame_cache[output_filename][0]
-                        ))
-                    )
+        self.video_cache.put(filename, frames)
 
-        req_frames += self.video_cache[filename]
+        # Frames are views into the memory mapped cache so only frames that are used get read from disk
+        req_frames += list(frames)
 
         return req_frames
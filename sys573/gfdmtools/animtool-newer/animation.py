@@ -1,6 +1,11 @@
+import collections
+import concurrent.futures
 import ctypes
+import os
 import struct
 
+from multiprocessing import shared_memory
+
 import hexdump
 import imageio
 import numpy
@@ -657,11 +662,190 @@ def read_animation_from_dat(infile, entry_count, animation_filenames, sprite_fil
     return render_by_timestamp, (frame_width, frame_height)
 
 
-def do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites):
+def shift_div255(v):
+    # Division by 255 the same way PIL does it
+    return ((v >> 8) + v) >> 8
+
+
+def div255(v):
+    # Rounded division by 255 the same way PIL does it
+    return shift_div255(v + 128)
+
+
+def composite_layer(frame, layer, x, y, blend_mode=None):
+    # Blends an RGBA layer into the frame at (x, y) in place, matching the results of the PIL
+    # functions that were used before. Pixels outside of the layer are never changed by any of
+    # the blend modes so only the area covered by the layer is touched.
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + layer.shape[1], frame.shape[1])
+    y1 = min(y + layer.shape[0], frame.shape[0])
+
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    # Everything except alpha compositing fits in 16 bits
+    src = layer[y0-y:y1-y, x0-x:x1-x].astype(numpy.uint16)
+    dst = frame[y0:y1, x0:x1].astype(numpy.uint16)
+
+    if blend_mode == 1:
+        # ImageChops.add
+        out = numpy.minimum(dst + src, 255)
+
+    elif blend_mode == 2:
+        # ImageChops.subtract
+        out = numpy.where(dst > src, dst - src, 0)
+
+    elif blend_mode is not None:
+        # Image.paste with the layer as its own mask
+        mask = src[:, :, 3:4]
+        out = div255(dst * (255 - mask) + src * mask)
+
+    else:
+        # Image.alpha_composite
+        src = src.astype(numpy.uint32)
+        dst = dst.astype(numpy.uint32)
+        src_a = src[:, :, 3:4]
+        dst_a = dst[:, :, 3:4]
+
+        outa255 = src_a * 255 + dst_a * (255 - src_a)
+        coef1 = (src_a * (255 * 255 * 128)) // numpy.maximum(outa255, 1)
+        coef2 = 255 * 128 - coef1
+
+        out = numpy.empty(dst.shape, dtype=numpy.uint32)
+        out[:, :, :3] = shift_div255(src[:, :, :3] * coef1 + dst[:, :, :3] * coef2 + (0x80 << 7)) >> 7
+        out[:, :, 3:4] = div255(outa255)
+        out = numpy.where(src_a == 0, dst, out)
+
+    frame[y0:y1, x0:x1] = out
+
+
+class TransformCache:
+    # LRU cache of transformed sprites that is limited by the total size of the sprites in bytes
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.sprites = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        layer = self.sprites.get(key, None)
+
+        if layer is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.sprites.move_to_end(key)
+
+        return layer
+
+    def put(self, key, layer):
+        if key in self.sprites:
+            self.size -= self.sprites.pop(key).nbytes
+
+        self.sprites[key] = layer
+        self.size += layer.nbytes
+
+        # The sprite that was just added is always kept even if it's bigger than the cache by itself
+        while self.size > self.capacity and len(self.sprites) > 1:
+            _, evicted_layer = self.sprites.popitem(last=False)
+            self.size -= evicted_layer.nbytes
+            self.evictions += 1
+
+    def get_stats(self):
+        return {
+            'sprites': len(self.sprites),
+            'size': self.size,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def get_transform_key(entry, upscale_ratio):
+    # Everything that affects what a sprite looks like before it gets placed in the frame.
+    # Images that aren't from the FCN are identified by the object itself since they're
+    # shared between all of the frames that use them.
+    sprite = entry['filename'] if not isinstance(entry['filename'], Image.Image) else id(entry['filename'])
+
+    return (
+        sprite,
+        entry.get('clut', None),
+        upscale_ratio,
+        entry.get('center_x', None),
+        entry.get('center_y', None),
+        entry.get('opacity', 1.0),
+        entry['x_zoom'],
+        entry['y_zoom'],
+        entry.get('offset_x', None),
+        entry.get('offset_y', None),
+        entry.get('rotate', None),
+    )
+
+
+def transform_sprite(image, entry, upscale_ratio):
+    center_x = entry.get('center_x', image.width // 2) * upscale_ratio
+    center_y = entry.get('center_y', image.height // 2) * upscale_ratio
+
+    if center_x != image.width // 2 or center_y != image.height // 2:
+        image3 = Image.new(image.mode, (image.width * 2, image.height * 2), (0, 0, 0, 0))
+        image3.paste(image, ((image3.width // 2) - center_x, (image3.height // 2) - center_y), image)
+
+        image.close()
+        del image
+
+        image = image3
+
+    if entry.get('opacity', 1.0) != 1.0:
+        pixels = numpy.array(image.convert("RGBA"))
+        pixels[:, :, 3] = numpy.minimum(pixels[:, :, 3] * entry.get('opacity', 1.0), 255).astype(numpy.uint8)
+        image = Image.fromarray(pixels, "RGBA")
+
+    new_w = image.width * entry['x_zoom']
+    new_h = image.height * entry['y_zoom']
+
+    if new_w < 0:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        new_w = abs(new_w)
+
+    if new_h < 0:
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        new_h = abs(new_h)
+
+    new_w = round(new_w)
+    new_h = round(new_h)
+
+    if (new_w, new_h) != image.size:
+        if new_w <= 0 or new_h <= 0:
+            image = Image.new(image.mode, image.size, (0, 0, 0, 0))
+        else:
+            image = image.resize((new_w, new_h))
+
+    if 'offset_x' in entry:
+        image = ImageChops.offset(image, entry['offset_x'] * upscale_ratio, 0)
+
+    if 'offset_y' in entry:
+        image = ImageChops.offset(image, 0, entry['offset_y'] * upscale_ratio)
+
+    if 'rotate' in entry:
+        image = image.rotate(-entry['rotate'], expand=True)
+
+    layer = numpy.asarray(image.convert("RGBA"))
+    layer.flags.writeable = False
+
+    return layer
+
+
+def do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites, transform_cache=None):
     if DEBUG_MODE:
         print()
 
-    render_frame = Image.new("RGBA", (frame_width * upscale_ratio, frame_height * upscale_ratio), (0, 0, 0, 0))
+    frame = numpy.zeros((frame_height * upscale_ratio, frame_width * upscale_ratio, 4), dtype=numpy.uint8)
     for k2 in sorted(render_by_timestamp[k].keys())[::-1]:
         if not render_by_timestamp[k][k2] or 'filename' not in render_by_timestamp[k][k2]:
             continue
@@ -669,138 +853,135 @@ def do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_rati
         if DEBUG_MODE:
             print(k, k2, render_by_timestamp[k][k2])
 
-        if isinstance(render_by_timestamp[k][k2]['filename'], Image.Image):
-            image = render_by_timestamp[k][k2]['filename'].copy()
+        if not isinstance(render_by_timestamp[k][k2]['filename'], Image.Image) and render_by_timestamp[k][k2]['filename'] not in fcn_sprites:
+            print("Couldn't find", render_by_timestamp[k][k2]['filename'])
+            continue
 
-        else:
-            if render_by_timestamp[k][k2]['filename'] not in fcn_sprites:
-                print("Couldn't find", render_by_timestamp[k][k2]['filename'])
-                continue
+        transform_key = get_transform_key(render_by_timestamp[k][k2], upscale_ratio)
+        layer = transform_cache.get(transform_key) if transform_cache is not None else None
 
-            image = fcn_sprites[render_by_timestamp[k][k2]['filename']][render_by_timestamp[k][k2]['clut']].copy()
+        if layer is None:
+            if isinstance(render_by_timestamp[k][k2]['filename'], Image.Image):
+                image = render_by_timestamp[k][k2]['filename'].copy()
 
-        center_x = render_by_timestamp[k][k2].get('center_x', image.width // 2) * upscale_ratio
-        center_y = render_by_timestamp[k][k2].get('center_y', image.height // 2) * upscale_ratio
+            else:
+                image = fcn_sprites[render_by_timestamp[k][k2]['filename']][render_by_timestamp[k][k2]['clut']].copy()
 
-        if center_x != image.width // 2 or center_y != image.height // 2:
-            image3 = Image.new(image.mode, (image.width * 2, image.height * 2), (0, 0, 0, 0))
-            image3.paste(image, ((image3.width // 2) - center_x, (image3.height // 2) - center_y), image)
+            layer = transform_sprite(image, render_by_timestamp[k][k2], upscale_ratio)
 
-            image.close()
-            del image
+            if transform_cache is not None:
+                transform_cache.put(transform_key, layer)
 
-            image = image3
+        new_x = render_by_timestamp[k][k2]['x'] * upscale_ratio - (frame_width // 2)
+        new_x = int(new_x + ((frame_width - layer.shape[1]) // 2))
 
-        if render_by_timestamp[k][k2].get('opacity', 1.0) != 1.0:
-            pixels = image.load()
-            for y in range(image.height):
-                for x in range(image.width):
-                    pixels[x, y] = (pixels[x, y][0], pixels[x, y][1], pixels[x, y][2], int(pixels[x, y][3] * render_by_timestamp[k][k2].get('opacity', 1.0)))
+        new_y = render_by_timestamp[k][k2]['y'] * upscale_ratio - (frame_height // 2)
+        new_y = int(new_y + ((frame_height - layer.shape[0]) // 2))
 
-        new_w = image.width * render_by_timestamp[k][k2]['x_zoom']
-        new_h = image.height * render_by_timestamp[k][k2]['y_zoom']
+        tile = render_by_timestamp[k][k2].get('tile', 0)
 
-        if new_w < 0:
-            image = image.transpose(Image.FLIP_LEFT_RIGHT)
-            new_w = abs(new_w)
+        if tile == 1:
+            layer = numpy.tile(layer, (-(-frame.shape[0] // layer.shape[0]), -(-frame.shape[1] // layer.shape[1]), 1))[:frame.shape[0], :frame.shape[1]]
+            layer_x, layer_y = 0, 0
 
-        if new_h < 0:
-            image = image.transpose(Image.FLIP_TOP_BOTTOM)
-            new_h = abs(new_h)
+        elif tile == 2:
+            layer = numpy.tile(layer, (1, -(-frame.shape[1] // layer.shape[1]), 1))[:, :frame.shape[1]]
+            layer_x, layer_y = 0, new_y
 
-        new_w = round(new_w)
-        new_h = round(new_h)
+        elif tile == 3:
+            layer = numpy.tile(layer, (-(-frame.shape[0] // layer.shape[0]), 1, 1))[:frame.shape[0]]
+            layer_x, layer_y = new_x, 0
 
-        if (new_w, new_h) != image.size:
-            if new_w <= 0 or new_h <= 0:
-                image = Image.new(image.mode, image.size, (0, 0, 0, 0))
-            else:
-                image = image.resize((new_w, new_h))
+        else:
+            # Pasting a sprite onto a transparent layer using itself as the mask
+            layer = layer.astype(numpy.uint16)
+            layer = div255(layer * layer[:, :, 3:4])
+            layer_x, layer_y = new_x, new_y
 
-        if 'offset_x' in render_by_timestamp[k][k2]:
-            image = ImageChops.offset(image, render_by_timestamp[k][k2]['offset_x'] * upscale_ratio, 0)
+        composite_layer(frame, layer, layer_x, layer_y, render_by_timestamp[k][k2].get('blend_mode', None))
 
-        if 'offset_y' in render_by_timestamp[k][k2]:
-            image = ImageChops.offset(image, 0, render_by_timestamp[k][k2]['offset_y'] * upscale_ratio)
+    return Image.fromarray(frame, "RGBA")
 
-        if 'rotate' in render_by_timestamp[k][k2]:
-            image = image.rotate(-render_by_timestamp[k][k2]['rotate'], expand=True)
 
-        image2 = Image.new(render_frame.mode, render_frame.size, (0, 0, 0, 0))
+def parse_dat_inner_single(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1, transform_cache_size=0x10000000):
+    rendered_frames = {}
+    transform_cache = TransformCache(transform_cache_size)
 
-        new_x = render_by_timestamp[k][k2]['x'] * upscale_ratio - (frame_width // 2)
-        new_x = int(new_x + ((frame_width - image.width) // 2))
+    with imageio.get_writer(output_filename, mode='I', fps=60, quality=10, format='FFMPEG') as writer:
+        for k in tqdm.tqdm(sorted(render_by_timestamp.keys())):
+            rendered_frame = do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites, transform_cache)
 
-        new_y = render_by_timestamp[k][k2]['y'] * upscale_ratio - (frame_height // 2)
-        new_y = int(new_y + ((frame_height - image.height) // 2))
+            npdata = numpy.asarray(rendered_frame, dtype='uint8')
+            writer.append_data(npdata)
 
-        if render_by_timestamp[k][k2].get('tile', 0) == 1:
-            for i in range(0, image2.width, image.width):
-                for j in range(0, image2.height, image.height):
-                    image2.paste(image, (i, j))
+    return transform_cache.get_stats()
 
-        elif render_by_timestamp[k][k2].get('tile', 0) == 2:
-            for i in range(0, image2.width, image.width):
-                image2.paste(image, (i, new_y))
 
-        elif render_by_timestamp[k][k2].get('tile', 0) == 3:
-            for j in range(0, image2.height, image.height):
-                image2.paste(image, (new_x, j))
+def pack_sprites(fcn_sprites):
+    # Copy the pixel data of every sprite into one shared memory block so it only
+    # exists once no matter how many worker processes are used
+    sprite_data = []
+    total_size = 0
+    for filename in fcn_sprites:
+        if not isinstance(fcn_sprites[filename], dict):
+            continue
 
-        else:
-            image2.paste(image, (new_x, new_y), image)
+        for clut in fcn_sprites[filename]:
+            image = fcn_sprites[filename][clut]
+            data = image.tobytes()
+            sprite_data.append((filename, clut, image.mode, image.size, total_size, data))
+            total_size += len(data)
 
-        if 'blend_mode' in render_by_timestamp[k][k2]:
-            if render_by_timestamp[k][k2]['blend_mode'] == 1:
-                render_frame = ImageChops.add(render_frame, image2)
+    shm = shared_memory.SharedMemory(create=True, size=max(total_size, 1))
 
-            elif render_by_timestamp[k][k2]['blend_mode'] == 2:
-                render_frame = ImageChops.subtract(render_frame, image2)
+    layout = []
+    for filename, clut, mode, size, offset, data in sprite_data:
+        shm.buf[offset:offset+len(data)] = data
+        layout.append((filename, clut, mode, size, offset, len(data)))
 
-            else:
-                render_frame.paste(image2, (0, 0), image2)
+    return shm, layout
 
-        else:
-            render_frame = Image.alpha_composite(render_frame, image2)
 
-    return render_frame
+def unpack_sprites(shm, layout):
+    fcn_sprites = {}
 
+    for filename, clut, mode, size, offset, length in layout:
+        if filename not in fcn_sprites:
+            fcn_sprites[filename] = {}
 
-def parse_dat_inner_single(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1):
-    rendered_frames = {}
+        fcn_sprites[filename][clut] = Image.frombuffer(mode, size, shm.buf[offset:offset+length], "raw", mode, 0, 1)
 
-    with imageio.get_writer(output_filename, mode='I', fps=60, quality=10, format='FFMPEG') as writer:
-        for k in tqdm.tqdm(sorted(render_by_timestamp.keys())):
-            rendered_frame = do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites)
+    return fcn_sprites
 
-            npdata = numpy.asarray(rendered_frame, dtype='uint8')
-            writer.append_data(npdata)
 
+render_worker_state = None
 
-def parse_dat_inner_multi(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1, max_threads=8):
-    rendered_frames = {}
+def init_render_worker(render_by_timestamp, frame_width, frame_height, upscale_ratio, shm_name, sprite_layout, transform_cache_size):
+    global render_worker_state
 
-    import queue
-    import threading
-    def thread_worker():
-        while True:
-            k = queue_data.get()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    fcn_sprites = unpack_sprites(shm, sprite_layout)
+
+    # Keep a reference to the shared memory so it stays mapped for as long as the worker is alive
+    render_worker_state = (render_by_timestamp, frame_width, frame_height, upscale_ratio, fcn_sprites, shm, TransformCache(transform_cache_size))
 
-            if k is None:
-                break
 
-            rendered_frames[k] = do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites)
+def render_frames_worker(frame_keys):
+    render_by_timestamp, frame_width, frame_height, upscale_ratio, fcn_sprites, _, transform_cache = render_worker_state
 
-            queue_data.task_done()
+    frames = []
+    for k in frame_keys:
+        rendered_frame = do_render_frame(render_by_timestamp, frame_width, frame_height, upscale_ratio, k, fcn_sprites, transform_cache)
+        frames.append(numpy.asarray(rendered_frame, dtype='uint8'))
+        rendered_frame.close()
 
-    queue_data = queue.Queue()
-    threads = []
-    for _ in range(max_threads):
-        thread = threading.Thread(target=thread_worker)
-        thread.start()
-        threads.append(thread)
+    # Each worker has its own cache so the stats are reported per process
+    return os.getpid(), transform_cache.get_stats(), frames
 
-    for k in render_by_timestamp:
+
+def parse_dat_inner_multi(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1, max_threads=8, chunk_size=8, transform_cache_size=0x10000000):
+    frame_keys = []
+    for k in sorted(render_by_timestamp.keys()):
         # Only render frames within the specified range
         if render_start_frame >= 0 and k < render_start_frame:
             continue
@@ -808,26 +989,50 @@ def parse_dat_inner_multi(render_by_timestamp, output_filename, fcn_sprites, fra
         if render_end_frame >= 0 and k > render_end_frame:
             continue
 
-        queue_data.put((k))
+        frame_keys.append(k)
 
-    queue_data.join()
+    chunks = iter([frame_keys[i:i+chunk_size] for i in range(0, len(frame_keys), chunk_size)])
 
-    for _ in range(max_threads):
-        queue_data.put(None)
+    shm, sprite_layout = pack_sprites(fcn_sprites)
+    worker_stats = {}
 
-    for thread in threads:
-        thread.join()
+    try:
+        initargs = (render_by_timestamp, frame_width, frame_height, upscale_ratio, shm.name, sprite_layout, transform_cache_size)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_threads, initializer=init_render_worker, initargs=initargs) as executor:
+            with imageio.get_writer(output_filename, mode='I', fps=60, quality=10, format='FFMPEG') as writer:
+                # Chunks are written in the order they were submitted, and only a limited number
+                # of chunks are rendered ahead of the writer so memory usage stays bounded
+                pending = collections.deque()
+                for _ in range(max_threads * 2):
+                    chunk = next(chunks, None)
 
-    with imageio.get_writer(output_filename, mode='I', fps=60, quality=10, format='FFMPEG') as writer:
-        for k in sorted(rendered_frames, key=lambda x:int(x)):
-            render_frame = rendered_frames[k]
-            npdata = numpy.asarray(render_frame, dtype='uint8')
-            writer.append_data(npdata)
+                    if chunk is None:
+                        break
 
-            render_frame.close()
+                    pending.append(executor.submit(render_frames_worker, chunk))
 
+                with tqdm.tqdm(total=len(frame_keys)) as progress:
+                    while pending:
+                        pid, stats, rendered_frames = pending.popleft().result()
+                        worker_stats[pid] = stats
 
-def parse_dat(dat_filename, output_filename, sprite_filenames, fcn_sprites, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1, max_threads=8):
+                        chunk = next(chunks, None)
+                        if chunk is not None:
+                            pending.append(executor.submit(render_frames_worker, chunk))
+
+                        for npdata in rendered_frames:
+                            writer.append_data(npdata)
+
+                        progress.update(len(rendered_frames))
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return {k: sum(stats[k] for stats in worker_stats.values()) for k in ['sprites', 'size', 'capacity', 'hits', 'misses', 'evictions']}
+
+
+def parse_dat(dat_filename, output_filename, sprite_filenames, fcn_sprites, upscale_ratio=1, render_start_frame=-1, render_end_frame=-1, max_threads=8, transform_cache_size=0x10000000):
     with open(dat_filename, "rb") as infile:
         if infile.read(4) != b"AEBG":
             print("Not a AEBG animation file")
@@ -842,10 +1047,13 @@ def parse_dat(dat_filename, output_filename, sprite_filenames, fcn_sprites, upsc
     start_time = time.time()
 
     if max_threads == 1:
-        parse_dat_inner_single(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio, render_start_frame, render_end_frame)
+        transform_cache_stats = parse_dat_inner_single(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio, render_start_frame, render_end_frame, transform_cache_size)
 
     else:
-        parse_dat_inner_multi(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio, render_start_frame, render_end_frame, max_threads)
+        transform_cache_stats = parse_dat_inner_multi(render_by_timestamp, output_filename, fcn_sprites, frame_width, frame_height, upscale_ratio, render_start_frame, render_end_frame, max_threads, transform_cache_size=transform_cache_size)
 
     print(time.time() - start_time, "elapsed")
 
+    lookups = transform_cache_stats['hits'] + transform_cache_stats['misses']
+    print("Transform cache: %d hits, %d misses (%.1f%% hit rate), %d evictions" % (transform_cache_stats['hits'], transform_cache_stats['misses'], transform_cache_stats['hits'] * 100 / max(lookups, 1), transform_cache_stats['evictions']))
+
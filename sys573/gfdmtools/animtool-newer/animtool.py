@@ -13,7 +13,8 @@ if __name__ == "__main__":
     parser.add_argument('--upscale-method', help='Upscale method: cpu|gpu|cudnn', default="cpu")
     parser.add_argument('--start-frame', help='Frame to start rendering', type=int, default=-1)
     parser.add_argument('--end-frame', help='Frame to end rendering', type=int, default=-1)
-    #parser.add_argument('--threads', help='Number of threads to use for rendering', type=int, default=8)
+    parser.add_argument('--threads', help='Number of processes to use for rendering', type=int, default=os.cpu_count())
+    parser.add_argument('--transform-cache-size', help='Maximum size of transformed sprites cached per process in MB', type=int, default=256)
     args = parser.parse_args()
 
     if args.upscale_method not in ['cpu', 'gpu', 'cudnn']:
@@ -28,4 +29,4 @@ if __name__ == "__main__":
     obj_filename = [x for x in fcn_files if x.endswith('.obj')][0]
     sprite_filenames = sprites.parse_obj(fcn_files[obj_filename], fcn_files)
 
-    animation.parse_dat(args.input_dat, args.output, sprite_filenames, fcn_files, args.upscale_ratio, args.start_frame, args.end_frame, 1)
+    animation.parse_dat(args.input_dat, args.output, sprite_filenames, fcn_files, args.upscale_ratio, args.start_frame, args.end_frame, args.threads, args.transform_cache_size * 1024 * 1024)
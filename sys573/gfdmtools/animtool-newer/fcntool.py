@@ -11,8 +11,47 @@ from PIL import Image
 import tim2png
 
 
-def parse_sprite_sheet(filename, fcn_files):
-    _, cluts = tim2png.readTimImage(io.BytesIO(fcn_files[filename]), 0)
+def get_tim(filename, fcn_files, tims):
+    # Each TIM is only parsed once, every CLUT is applied to the same decoded pixel data
+    if filename not in tims:
+        tims[filename] = tim2png.readTim(io.BytesIO(fcn_files[filename]))
+
+    return tims[filename]
+
+
+def stitch_sprite_sheet(related_tims, clut):
+    # Load all files into memory to be stitched together into one large image
+    related_images = []
+    max_width = 0
+    max_height = 0
+    for related_tim in related_tims:
+        image = tim2png.decodeTimImage(related_tim, clut)
+        related_images.append(image)
+
+        if image.width > max_width:
+            max_width = image.width
+
+        max_height += image.height
+
+    image = Image.new('RGBA', (max_width, max_height), (0, 0, 0, 0))
+
+    # Stitch together all sprite images
+    cur_y = 0
+    for related_image in related_images:
+        image.paste(related_image, (0, cur_y), related_image)
+        cur_y += related_image.height
+
+    return image
+
+
+def parse_sprite_sheet(filename, fcn_files, tims=None, sprite_sheets=None):
+    if tims is None:
+        tims = {}
+
+    if sprite_sheets is None:
+        sprite_sheets = {}
+
+    cluts = get_tim(filename, fcn_files, tims)['clut_count']
 
     if '@' in filename:
         match = re.search(r'([^\@]*)@(\d+)_(\d+)(\..*)?', filename)
@@ -28,34 +67,27 @@ def parse_sprite_sheet(filename, fcn_files):
         split_width = 1
         split_height = 1
 
-    # Find all related files
-    related_files = []
-    for fcn_filename in fcn_files:
-        if fcn_filename.startswith(base_filename + '@') or fcn_filename.startswith(base_filename + '.'):
-            related_files.append(fcn_filename)
-
-    output = {}
-    for clut in range(0, cluts + 1):
-        # Load all files into memory to be stitched together into one large image
-        related_images = []
-        max_width = 0
-        max_height = 0
-        for related_file in related_files:
-            image, _ = tim2png.readTimImage(io.BytesIO(fcn_files[related_file]), clut)
-            related_images.append(image)
+    # Find all related files, every file in the sprite sheet shares the same stitched images
+    if base_filename not in sprite_sheets:
+        related_files = []
+        for fcn_filename in fcn_files:
+            if fcn_filename.startswith(base_filename + '@') or fcn_filename.startswith(base_filename + '.'):
+                related_files.append(fcn_filename)
 
-            if image.width > max_width:
-                max_width = image.width
+        sprite_sheets[base_filename] = {
+            'related_files': related_files,
+            'images': {},
+        }
 
-            max_height += image.height
+    sprite_sheet = sprite_sheets[base_filename]
 
-        image = Image.new('RGBA', (max_width, max_height), (0, 0, 0, 0))
+    output = {}
+    for clut in range(0, cluts + 1):
+        if clut not in sprite_sheet['images']:
+            related_tims = [get_tim(related_file, fcn_files, tims) for related_file in sprite_sheet['related_files']]
+            sprite_sheet['images'][clut] = stitch_sprite_sheet(related_tims, clut)
 
-        # Stitch together all sprite images
-        cur_y = 0
-        for related_image in related_images:
-            image.paste(related_image, (0, cur_y), related_image)
-            cur_y += related_image.height
+        image = sprite_sheet['images'][clut]
 
         # Split up sprite sheet into correct sprites
         cur_idx = 0
@@ -120,6 +152,8 @@ def get_images_from_fcn(filename):
 
     # Actually read in the images
     output_images = {}
+    tims = {}
+    sprite_sheets = {}
     for filename in output_files:
         print("Extracting", filename)
 
@@ -128,16 +162,15 @@ def get_images_from_fcn(filename):
 
         else:
             if '@' in filename or '.' in filename:
-                output_images.update(parse_sprite_sheet(filename, output_files))
+                output_images.update(parse_sprite_sheet(filename, output_files, tims, sprite_sheets))
 
             else:
-                image, cluts = tim2png.readTimImage(io.BytesIO(output_files[filename]), 0)
+                tim = get_tim(filename, output_files, tims)
 
-                output_images[filename] = { 0: image }
+                output_images[filename] = { 0: tim2png.decodeTimImage(tim, 0) }
 
-                for clut in range(1, cluts):
-                    image, _ = tim2png.readTimImage(io.BytesIO(output_files[filename]), clut)
-                    output_images[filename][clut] = image
+                for clut in range(1, tim['clut_count']):
+                    output_images[filename][clut] = tim2png.decodeTimImage(tim, clut)
 
     return output_images
 
@@ -1,8 +1,11 @@
 import argparse
+import concurrent.futures
+import functools
 import hashlib
 import json
 import os
 import sys
+import time
 
 DATABASE_FILENAME = "db.json"
 
@@ -31,8 +34,10 @@ def get_database(filename=DATABASE_FILENAME):
 
 
 
-def get_key_information(sha1):
-    db = get_database()
+def get_key_information(sha1, db=None):
+    if db is None:
+        db = get_database()
+
     sha1 = sha1.upper()
 
     song = db.get(sha1, None)
@@ -50,8 +55,7 @@ def is_bit_set(value, n):
     return (value >> n) & 1
 
 
-# Thanks SaxxonPike for helping with this one
-def decrypt_ddrsbm(data, data_len, key):
+def get_ddrsbm_key_data(key):
     def rot(c):
         return ((c >> 7) & 1) | ((c << 1) & 0xff)
 
@@ -81,6 +85,13 @@ def decrypt_ddrsbm(data, data_len, key):
 
     scramble = bytearray([key_data[-1]]) + key_data[:-1]
 
+    return key_data, scramble
+
+
+# Thanks SaxxonPike for helping with this one
+def decrypt_ddrsbm(data, data_len, key):
+    key_data, scramble = get_ddrsbm_key_data(key)
+
     key_len = len(key_data)
     scramble_len = len(scramble)
     output_idx = 0
@@ -237,59 +248,237 @@ def encrypt(data, data_len, key1, key2, key3):
     return bytearray(output_data)
 
 
-def main():
-    parser = argparse.ArgumentParser()
+# NumPy versions of the above for when the Cython module isn't available.
+# Every word only depends on its position and the key state at that point, so the
+# key schedule is generated for the whole file up front and applied with array ops.
+DECRYPT_KEY3_ORDER = (7, 0, 6, 1, 5, 2, 4, 3, 3, 4, 2, 5, 1, 6, 0, 7)
+ENCRYPT_KEY3_ORDER = (3, 4, 2, 5, 1, 6, 0, 7, 7, 0, 6, 1, 5, 2, 4, 3)
 
-    parser.add_argument('--input', help='Input file', default=None)
-    parser.add_argument('--output', help='Output file', default=None)
-    parser.add_argument('--sha1', help='Force usage of a specific SHA-1 for encryption keys (optional)', default=None)
 
-    parser.add_argument('--key1', help='Key 1 (optional)', default=None, type=int)
-    parser.add_argument('--key2', help='Key 2 (optional)', default=None, type=int)
-    parser.add_argument('--key3', help='Key 3 (optional)', default=None, type=int)
+def get_key_schedule_numpy(data_len, key1, key2, key3):
+    import numpy as np
 
-    parser.add_argument('--native', help='Native decryption code only', default=False, action='store_true')
-    parser.add_argument('--encrypt', help='Encrypt input instead of decrypt (uses 0,0,0 as key)', default=False, action='store_true')
-    parser.add_argument('--no-remove-garbage', help='Output the raw, untouched decrypted file (will include garbage bytes before MP3 data)', default=False, action='store_true')
+    idx = np.arange(data_len, dtype=np.int64)
+    key1 &= 0xffff
+    key2 &= 0xffff
 
-    args = parser.parse_args()
+    # key1 keeps bit 15 and rotates the lower 15 bits, so it repeats every 15 words
+    key1_table = np.zeros(15, dtype=np.uint32)
+    cur_key1 = key1
+    for i in range(15):
+        key1_table[i] = cur_key1
+        cur_key1 = ((cur_key1 & 0x8000) | ((cur_key1 << 1) & 0x7ffe) | ((cur_key1 >> 14) & 1)) & 0xffff
 
-    if not args.input:
-        parser.print_help(sys.stderr)
-        exit(-1)
+    key1s = key1_table[idx % 15]
 
-    if not os.path.exists(args.input):
-        print("Could not find file:", args.input)
-        exit(-1)
+    # key2 is rotated by 1 every time the updated key1 has bit 15 and bit 0 differ
+    updated_key1s = key1_table[(idx + 1) % 15]
+    rotate = ((updated_key1s >> 15) ^ updated_key1s) & 1
+    rotations = ((np.cumsum(rotate) - rotate) % 16).astype(np.uint32)
+    key2s = ((key2 << rotations) | (key2 >> (16 - rotations))) & 0xffff
 
-    if args.output is None:
-        args.output = os.path.splitext(args.input)[0] + '.MP3'
+    key3s = (key3 + idx) & 0xff
+
+    return key1s, key2s, key3s
+
+
+def crypt_numpy(data, data_len, key1, key2, key3, key3_order):
+    import numpy as np
+
+    key3_table = np.array([
+        sum(is_bit_set(k, b) << (15 - i) for i, b in enumerate(key3_order)) for k in range(256)
+    ], dtype=np.uint32)
+
+    key1s, key2s, key3s = get_key_schedule_numpy(data_len, key1, key2, key3)
+    m = key1s ^ key2s
+
+    v = np.frombuffer(bytes(data[:data_len * 2]), dtype='<u2').astype(np.uint32)
+
+    # Swap neighboring bit pairs based on bits of m
+    for hi, lo, b in [(15, 14, 0xf), (13, 12, 0xe), (11, 10, 0xb), (9, 8, 0x9), (7, 6, 0x8), (5, 4, 0x5), (3, 2, 0x3), (1, 0, 0x2)]:
+        diff = ((v >> hi) ^ (v >> lo)) & (m >> b) & 1
+        v ^= (diff << hi) | (diff << lo)
 
-    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
-        os.makedirs(os.path.dirname(args.output))
+    for b, pos in [(0x0d, 14), (0x0c, 12), (0x0a, 10), (0x07, 8), (0x06, 6), (0x04, 4), (0x01, 2), (0x00, 0)]:
+        v ^= ((m >> b) & 1) << pos
+
+    v &= 0xffff
+    v ^= key3_table[key3s]
+
+    output_data = bytearray(len(data))
+    output_data[:data_len * 2] = v.astype('>u2').tobytes()
+
+    return output_data
+
+
+def decrypt_numpy(data, data_len, key1, key2, key3):
+    return crypt_numpy(data, data_len, key1, key2, key3, DECRYPT_KEY3_ORDER)
+
+
+def encrypt_numpy(data, data_len, key1, key2, key3):
+    return crypt_numpy(data, data_len, key1, key2, key3, ENCRYPT_KEY3_ORDER)
+
+
+def decrypt_ddrsbm_numpy(data, data_len, key):
+    import numpy as np
+
+    key_data, scramble = get_ddrsbm_key_data(key)
+
+    idx = np.arange(data_len) % 16
+    key_bytes = np.frombuffer(bytes(key_data), dtype=np.uint8).astype(np.uint32)[idx]
+    scramble_bytes = np.frombuffer(bytes(scramble), dtype=np.uint8).astype(np.uint32)[idx]
+
+    v = np.frombuffer(bytes(data[:data_len * 2]), dtype='<u2').astype(np.uint32)
+    output_words = np.zeros(data_len, dtype=np.uint32)
+
+    for cur_bit in range(0, 8):
+        even_bit_shift = cur_bit * 2
+        odd_bit_shift = cur_bit * 2 + 1
+
+        even_bits = (v >> even_bit_shift) & 1
+        odd_bits = (v >> odd_bit_shift) & 1
+        swap = (scramble_bytes >> cur_bit) & 1
+
+        # Swap the even and odd bits where the scramble bit is set
+        diff = (even_bits ^ odd_bits) & swap
+        even_bits ^= diff
+        odd_bits ^= diff
+
+        output_words |= ((even_bits ^ ((key_bytes >> cur_bit) & 1)) << even_bit_shift) | (odd_bits << odd_bit_shift)
+
+    output_data = bytearray(len(data))
+    output_data[:data_len * 2] = output_words.astype('>u2').tobytes()
+
+    return output_data
+
+
+# Based on mp3info.py
+MP3_BITRATES = [
+    [
+        # MPEG-2 & 2.5
+        [0,32,48,56, 64, 80, 96,112,128,144,160,176,192,224,256,None], # Layer 1
+        [0, 8,16,24, 32, 40, 48, 56, 64, 80, 96,112,128,144,160,None], # Layer 2
+        [0, 8,16,24, 32, 40, 48, 56, 64, 80, 96,112,128,144,160,None]  # Layer 3
+    ],
+    [
+        # MPEG-1
+        [0,32,64,96,128,160,192,224,256,288,320,352,384,416,448,None], # Layer 1
+        [0,32,48,56, 64, 80, 96,112,128,160,192,224,256,320,384,None], # Layer 2
+        [0,32,40,48, 56, 64, 80, 96,112,128,160,192,224,256,320,None]  # Layer 3
+    ]
+]
+MP3_SAMPLERATES = [
+    [ 11025, 12000,  8000, None], # MPEG-2.5
+    [  None,  None,  None, None], # reserved
+    [ 22050, 24000, 16000, None], # MPEG-2
+    [ 44100, 48000, 32000, None], # MPEG-1
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_mp3_frame_length(header1, header2):
+    # Frame length for the 2nd and 3rd bytes of a frame header, there are only 65536 possible combinations
+    mpeg_version = (header1 >> 3) & 0b11
+    layer = (header1 >> 1) & 0b11
+    bitrate = (header2 >> 4) & 0b1111
+    samplerate = (header2 >> 2) & 0b11
+    padding = (header2 >> 1) & 0b1
+
+    if mpeg_version not in [0, 2, 3]:
+        return None
+
+    layer = [None, 3, 2, 1][layer]
+    if layer is None:
+        return None
+
+    bitrate = MP3_BITRATES[mpeg_version & 1][layer - 1][bitrate]
+    samplerate = MP3_SAMPLERATES[mpeg_version][samplerate]
+
+    if bitrate is None or samplerate is None:
+        return None
+
+    # Free bitrate MP3s are not supported
+    if bitrate == 0:
+        return None
+
+    if layer == 3 and mpeg_version == 0 or mpeg_version == 2:
+        samplerate <<= 1
+
+    if layer == 1:
+        framelength = (12000 * bitrate / samplerate + padding) * 4
+
+    else:
+        framelength = 144000 * bitrate / samplerate + padding
+
+    return int(framelength)
+
+
+def find_mp3_start(data, requested_frames_synced=10):
+    data_len = len(data)
+
+    # Every frame starts with 0xff so only those offsets need to be checked
+    i = data.find(b'\xff')
+    while i != -1 and i + 4 <= data_len:
+        frames_synced = 0
+
+        # Try to read at least a fixed number MP3 frames before determining it's valid
+        cur_offset = i
+        while frames_synced < requested_frames_synced and cur_offset + 4 <= data_len:
+            # Frame sync check
+            if data[cur_offset] != 0xff or (data[cur_offset + 1] & 0b11100000) != 0b11100000:
+                break
+
+            # Bad emphasis bit
+            if (data[cur_offset + 3] & 0b11) == 0b10:
+                break
+
+            mp3_frame_length = get_mp3_frame_length(data[cur_offset + 1], data[cur_offset + 2])
+            if mp3_frame_length is None:
+                break
 
-    with open(args.input, "rb") as infile:
+            cur_offset += mp3_frame_length
+            frames_synced += 1
+
+        if frames_synced >= requested_frames_synced:
+            return i
+
+        i = data.find(b'\xff', i + 1)
+
+    return None
+
+
+def remove_garbage(output_data):
+    i = find_mp3_start(output_data)
+
+    if i is None:
+        return output_data, 0
+
+    return output_data[i:], i
+
+
+def process_file(input_filename, output_filename, key1=None, key2=None, key3=None, sha1=None, db=None, native=False, encrypt_input=False, no_remove_garbage=False):
+    with open(input_filename, "rb") as infile:
         data = infile.read()
 
-    if args.encrypt:
+    if encrypt_input:
         key1 = 0
         key2 = 0
         key3 = 0
 
-        if args.native:
-            decrypt_func = encrypt
+        if native:
+            try:
+                import numpy
+                decrypt_func = encrypt_numpy
+
+            except ImportError:
+                decrypt_func = encrypt
 
         else:
             import enc573
             decrypt_func = enc573.encrypt
 
     else:
-        key1 = args.key1
-        key2 = args.key2
-        key3 = args.key3
-
         if key1 is None or key2 is None or key3 is None:
-            sha1 = args.sha1
             if sha1 is None:
                 m = hashlib.sha1()
                 m.update(data)
@@ -298,14 +487,17 @@ def main():
             if sha1 is None:
                 raise Exception("A SHA-1 must be set to continue")
 
-            print("Using SHA-1:", sha1)
-
-            key1, key2, key3 = get_key_information(sha1)
+            key1, key2, key3 = get_key_information(sha1, db)
             if key1 is None:
                 raise Exception("Couldn't find key information for file with SHA-1 hash of %s" % (sha1))
 
-        if args.native:
-            decrypt_func, decrypt_ddrsbm_func = (decrypt, decrypt_ddrsbm)
+        if native:
+            try:
+                import numpy
+                decrypt_func, decrypt_ddrsbm_func = (decrypt_numpy, decrypt_ddrsbm_numpy)
+
+            except ImportError:
+                decrypt_func, decrypt_ddrsbm_func = (decrypt, decrypt_ddrsbm)
 
         else:
             import enc573
@@ -317,94 +509,151 @@ def main():
     else:
         output_data = decrypt_ddrsbm_func(data, len(data) // 2, key1)
 
-    if not args.no_remove_garbage:
-        def get_mp3_frame_length(bytes):
-            # Based on mp3info.py
-            BITRATES = [
-                [
-                    # MPEG-2 & 2.5
-                    [0,32,48,56, 64, 80, 96,112,128,144,160,176,192,224,256,None], # Layer 1
-                    [0, 8,16,24, 32, 40, 48, 56, 64, 80, 96,112,128,144,160,None], # Layer 2
-                    [0, 8,16,24, 32, 40, 48, 56, 64, 80, 96,112,128,144,160,None]  # Layer 3
-                ],
-                [
-                    # MPEG-1
-                    [0,32,64,96,128,160,192,224,256,288,320,352,384,416,448,None], # Layer 1
-                    [0,32,48,56, 64, 80, 96,112,128,160,192,224,256,320,384,None], # Layer 2
-                    [0,32,40,48, 56, 64, 80, 96,112,128,160,192,224,256,320,None]  # Layer 3
-                ]
-            ]
-            SAMPLERATES = [
-                [ 11025, 12000,  8000, None], # MPEG-2.5
-                [  None,  None,  None, None], # reserved
-                [ 22050, 24000, 16000, None], # MPEG-2
-                [ 44100, 48000, 32000, None], # MPEG-1
-            ]
+    garbage_len = 0
+    if not no_remove_garbage:
+        output_data, garbage_len = remove_garbage(output_data)
 
-            # Frame sync check
-            if bytes[0] != 0xff and ((bytes[1] >> 5) & 0b111) != 0b111:
-                return None
+    if os.path.dirname(output_filename) and not os.path.exists(os.path.dirname(output_filename)):
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-            # Bad emphasis bit
-            if (bytes[3] & 0b11) == 0b10:
-                return None
+    with open(output_filename, "wb") as outfile:
+        outfile.write(output_data)
 
-            mpeg_version = (bytes[1] >> 3) & 0b11
-            layer = (bytes[1] >> 1) & 0b11
-            bitrate = (bytes[2] >> 4) & 0b1111
-            samplerate = (bytes[2] >> 2) & 0b11
-            padding = (bytes[2] >> 1) & 0b1
+    return {
+        'sha1': sha1,
+        'garbage_len': garbage_len,
+        'size': len(data),
+    }
 
-            if mpeg_version not in [0, 2, 3]:
-                return None
 
-            layer = [None, 3, 2, 1][layer]
-            if layer is None:
-                return None
+worker_args = None
 
-            bitrate = BITRATES[mpeg_version & 1][layer - 1][bitrate]
-            samplerate = SAMPLERATES[mpeg_version][samplerate]
+def init_batch_worker(db, args):
+    global worker_args
+    worker_args = (db, args)
 
-            if bitrate is None or samplerate is None:
-                return None
 
-            if layer == 3 and mpeg_version == 0 or mpeg_version == 2:
-                samplerate <<= 1
+def process_file_worker(input_filename, output_filename):
+    db, args = worker_args
 
-            if layer == 1:
-                framelength = (12000 * bitrate / samplerate + padding) * 4
+    start_time = time.time()
 
-            else:
-                framelength = 144000 * bitrate / samplerate + padding
+    try:
+        info = process_file(input_filename, output_filename, db=db, native=args.native, encrypt_input=args.encrypt, no_remove_garbage=args.no_remove_garbage)
 
-            if bitrate == 0:
-                print("WARNING: This tool does not support free bitrate MP3s")
-                return None
+    except Exception as e:
+        return input_filename, output_filename, None, str(e)
 
-            return int(framelength)
+    info['elapsed'] = time.time() - start_time
 
+    return input_filename, output_filename, info, None
 
-        for i in range(len(output_data) - 4):
-            frames_synced = 0
-            requested_frames_synced = 10
 
-            # Try to read at least a fixed number MP3 frames before determining it's valid
-            cur_offset = i
-            while frames_synced < requested_frames_synced and cur_offset < len(output_data):
-                mp3_frame_length = get_mp3_frame_length(output_data[cur_offset:cur_offset+4])
-                if mp3_frame_length is None:
-                    break
+def get_batch_files(input_folder, output_folder, input_ext, output_ext):
+    # Pairs of (input, output) for every file in input_folder that doesn't have an up to date output already
+    files = []
 
-                cur_offset += mp3_frame_length
-                frames_synced += 1
+    for root, _, filenames in os.walk(input_folder):
+        for filename in sorted(filenames):
+            basename, ext = os.path.splitext(filename)
 
-            if frames_synced >= requested_frames_synced:
-                print("Removed %d bytes of garbage from header" % i)
-                output_data = output_data[i:]
-                break
+            if ext.upper() != input_ext:
+                continue
 
-    with open(args.output, "wb") as outfile:
-        outfile.write(output_data)
+            input_filename = os.path.join(root, filename)
+            output_filename = os.path.normpath(os.path.join(output_folder, os.path.relpath(root, input_folder), basename + output_ext))
+
+            if os.path.exists(output_filename) and os.path.getmtime(output_filename) >= os.path.getmtime(input_filename):
+                continue
+
+            files.append((input_filename, output_filename))
+
+    return files
+
+
+def process_batch(args):
+    input_ext, output_ext = (".MP3", ".DAT") if args.encrypt else (".DAT", ".MP3")
+
+    if args.output_dir is None:
+        args.output_dir = args.input_dir
+
+    files = get_batch_files(args.input_dir, args.output_dir, input_ext, output_ext)
+    print("Found %d files to process" % len(files))
+
+    if not files:
+        return
+
+    # The database is only parsed once and then handed to each worker
+    db = get_database() if not args.encrypt else None
+
+    total_size = 0
+    failed = 0
+    start_time = time.time()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=init_batch_worker, initargs=(db, args)) as executor:
+        futures = [executor.submit(process_file_worker, input_filename, output_filename) for input_filename, output_filename in files]
+
+        for future in concurrent.futures.as_completed(futures):
+            input_filename, output_filename, info, error = future.result()
+
+            if error is not None:
+                print("Failed %s: %s" % (input_filename, error))
+                failed += 1
+                continue
+
+            total_size += info['size']
+            print("%s -> %s (%d bytes, %.2f MB/s)" % (input_filename, output_filename, info['size'], info['size'] / max(info['elapsed'], 1e-6) / 0x100000))
+
+    elapsed = time.time() - start_time
+    print("Processed %d files (%d failed) in %.2fs, %.2f MB/s" % (len(files) - failed, failed, elapsed, total_size / max(elapsed, 1e-6) / 0x100000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', help='Input file', default=None)
+    parser.add_argument('--output', help='Output file', default=None)
+    parser.add_argument('--input-dir', help='Input folder for batch mode, all .DAT (or .MP3 with --encrypt) files in it will be processed', default=None)
+    parser.add_argument('--output-dir', help='Output folder for batch mode (defaults to the input folder)', default=None)
+    parser.add_argument('-j', '--jobs', help='Number of worker processes used in batch mode', default=os.cpu_count(), type=int)
+    parser.add_argument('--sha1', help='Force usage of a specific SHA-1 for encryption keys (optional)', default=None)
+
+    parser.add_argument('--key1', help='Key 1 (optional)', default=None, type=int)
+    parser.add_argument('--key2', help='Key 2 (optional)', default=None, type=int)
+    parser.add_argument('--key3', help='Key 3 (optional)', default=None, type=int)
+
+    parser.add_argument('--native', help='Native decryption code only (uses NumPy if available)', default=False, action='store_true')
+    parser.add_argument('--encrypt', help='Encrypt input instead of decrypt (uses 0,0,0 as key)', default=False, action='store_true')
+    parser.add_argument('--no-remove-garbage', help='Output the raw, untouched decrypted file (will include garbage bytes before MP3 data)', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    if args.input_dir:
+        if not os.path.isdir(args.input_dir):
+            print("Could not find folder:", args.input_dir)
+            exit(-1)
+
+        process_batch(args)
+        return
+
+    if not args.input:
+        parser.print_help(sys.stderr)
+        exit(-1)
+
+    if not os.path.exists(args.input):
+        print("Could not find file:", args.input)
+        exit(-1)
+
+    if args.output is None:
+        args.output = os.path.splitext(args.input)[0] + '.MP3'
+
+    info = process_file(args.input, args.output, args.key1, args.key2, args.key3, args.sha1, native=args.native, encrypt_input=args.encrypt, no_remove_garbage=args.no_remove_garbage)
+
+    if info['sha1'] is not None:
+        print("Using SHA-1:", info['sha1'])
+
+    if info['garbage_len'] > 0:
+        print("Removed %d bytes of garbage from header" % info['garbage_len'])
 
     print("Saved to", args.output)
 
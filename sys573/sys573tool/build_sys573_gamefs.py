@@ -1,4 +1,5 @@
 import argparse
+import bisect
 import copy
 import ctypes
 import glob
@@ -10,6 +11,7 @@ import struct
 import string
 
 import comp573
+import enc573
 import sum573
 
 
@@ -79,14 +81,8 @@ def encrypt_data(data, input_key):
 
     val = 0x41C64E6D
     key1 = (val * calculate_key(input_key)) & 0xffffffff
-    counter = 0
 
-    for idx, c in enumerate(data):
-        val = ((key1 + counter) >> 5) ^ c
-        data[idx] = val & 0xff
-        counter += 0x3039
-
-    return data
+    return enc573.crypt_data(data, key1)
 
 
 def get_filetable(input_folder, input_modified_list, patch_dir=""):
@@ -169,15 +165,80 @@ def get_data_from_entry(entry):
     return bytearray(data)
 
 
+class ExtentAllocator:
+    def __init__(self, size):
+        # Sorted, non-overlapping [start, end) extents of free space. Everything starts out as used.
+        self.size = size
+        self.starts = []
+        self.ends = []
+
+
+    def free(self, start, end):
+        start = max(start, 0)
+        end = min(end, self.size)
+
+        if end <= start:
+            return
+
+        # Merge with every free extent that overlaps or touches the new one
+        left = bisect.bisect_left(self.ends, start)
+        right = bisect.bisect_right(self.starts, end)
+
+        if left < right:
+            start = min(start, self.starts[left])
+            end = max(end, self.ends[right - 1])
+
+        self.starts[left:right] = [start]
+        self.ends[left:right] = [end]
+
+
+    def reserve(self, start, end):
+        if end <= start:
+            return
+
+        # Cut the range out of every free extent it overlaps, keeping whatever is left on either side
+        left = bisect.bisect_right(self.ends, start)
+        right = bisect.bisect_left(self.starts, end)
+
+        if left >= right:
+            return
+
+        starts = []
+        ends = []
+
+        if self.starts[left] < start:
+            starts.append(self.starts[left])
+            ends.append(start)
+
+        if self.ends[right - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[right - 1])
+
+        self.starts[left:right] = starts
+        self.ends[left:right] = ends
+
+
+    def find(self, size, alignment=0x800):
+        # First fit: the lowest aligned offset with enough free space after it
+        for start, end in zip(self.starts, self.ends):
+            if (start % alignment) != 0:
+                start += alignment - (start % alignment)
+
+            if start + size <= end:
+                return start
+
+        return -1
+
+
 def create_gamedata(entries, base_offset, memory, enc_key, override_edit_section):
     # You can modify this to default to unused and you can probably squeeze a little bit more data
     # into the cards, but you will almost surely run over some data you shouldn't touch so be careful.
-    memory_map = [bytearray([1] * len(mem)) for mem in memory] # 0 = unused, 1 = used
-    memory_map[0][:0x200000] = [1] * 0x200000 # Reserve this section for the program code
-    memory_map[1][0x18c0000:0x1b66800] = [1] * (0x1b66800 - 0x18c0000) # Reserve this section because it's where system sounds reside (not in actual file table)
+    memory_map = [ExtentAllocator(len(mem)) for mem in memory]
+    memory_map[0].reserve(0, 0x200000) # Reserve this section for the program code
+    memory_map[1].reserve(0x18c0000, 0x1b66800) # Reserve this section because it's where system sounds reside (not in actual file table)
 
     if override_edit_section:
-        memory_map[1][0x1b66800:0x2000000] = [0] * (0x2000000 - 0x1b66800) # Unreserve the space where edit data is normally stored
+        memory_map[1].free(0x1b66800, 0x2000000) # Unreserve the space where edit data is normally stored
 
     # Find the data
     entries_work = entries[::]
@@ -194,10 +255,10 @@ def create_gamedata(entries, base_offset, memory, enc_key, override_edit_section
             size += 0x800 - (size % 0x800)
 
         if entry.get('_free', False):
-            memory_map[entry.get('flag_loc', 0)][cur_memory:cur_memory + size] = [0] * size
+            memory_map[entry.get('flag_loc', 0)].free(cur_memory, cur_memory + size)
 
         else:
-            memory_map[entry.get('flag_loc', 0)][cur_memory:cur_memory + size] = [1] * size
+            memory_map[entry.get('flag_loc', 0)].reserve(cur_memory, cur_memory + size)
 
         entries_work.remove(entry)
 
@@ -261,7 +322,7 @@ def create_gamedata(entries, base_offset, memory, enc_key, override_edit_section
 
             memory[entry.get('flag_loc', 0)][cur_memory + entry['filesize']:cur_memory + entry['filesize'] + padding] = bytearray([0xff] * padding)
             memory[entry.get('flag_loc', 0)][cur_memory:cur_memory + entry['filesize']] = data
-            memory_map[entry.get('flag_loc', 0)][cur_memory:cur_memory + entry['filesize']] = [1] * size
+            memory_map[entry.get('flag_loc', 0)].reserve(cur_memory, cur_memory + size)
 
             entries_work.remove(entry)
             used_addresses.append((entry.get('flag_loc', 0), cur_memory))
@@ -298,59 +359,13 @@ def create_gamedata(entries, base_offset, memory, enc_key, override_edit_section
             is_dupe = True
 
         else:
-            # This code is not optimized. It sucks but it works.
-            # The general idea I was trying to implement is to find the first
-            # string of 0s in the memory map that could fit the size of the data
+            # Find the first sector aligned run of free space that could fit the size of the data
             # padded to the nearest sector (0x800).
             # The padding is key because if you can't clear out the sector properly
             # then the game has a higher chance of crashing for some reason.
             # Possibly due to decompression reading in garbage data as compressed data.
-            for loc in range(0, len(memory_map)):
-                loc = entry.get('flag_loc', 1)
-
-                cur_memory = 0
-
-                while cur_memory < len(memory_map[loc]):
-                    if (cur_memory % 0x800) != 0:
-                        cur_memory += (0x800 - (cur_memory % 0x800))
-
-                    idx = memory_map[loc].find(0, cur_memory)
-
-                    if idx == -1:
-                        cur_memory = -1
-                        break
-
-                    if (idx % 0x800) != 0:
-                        cur_memory = idx + 1
-                        continue
-
-                    cur_memory = idx
-                    idx = memory_map[loc].find(1, cur_memory, cur_memory + len(data) + padding)
-
-                    if idx != -1:
-                        cur_memory = idx
-
-                        if (idx % 0x800) != 0:
-                            cur_memory += 0x800 - (idx % 0x800)
-
-                        continue
-
-                    else:
-                        break
-
-                    if cur_memory > len(memory_map[loc]):
-                        cur_memory = -1
-                        break
-
-                if cur_memory > len(memory_map[loc]):
-                    cur_memory = - 1
-                    continue
-
-                if loc == 0 and cur_memory + len(data) + padding >= base_offset:
-                    continue
-
-                if cur_memory > 0:
-                    break
+            loc = entry.get('flag_loc', 1)
+            cur_memory = memory_map[loc].find(len(data) + padding)
 
             if cur_memory == -1 or (loc == 0 and cur_memory + len(data) + padding >= base_offset):
                 print("Couldn't find position for %08x" % len(data), entry)
@@ -366,7 +381,7 @@ def create_gamedata(entries, base_offset, memory, enc_key, override_edit_section
         size += padding
         memory[loc][cur_memory:cur_memory + len(data)] = data
         memory[loc][cur_memory + len(data):cur_memory + len(data) + padding] = bytearray([0xff] * padding)
-        memory_map[loc][cur_memory:cur_memory + len(data) + padding] = [1] * size
+        memory_map[loc].reserve(cur_memory, cur_memory + size)
 
         entry['filesize'] = len(data)
         used_addresses.append((loc, cur_memory))
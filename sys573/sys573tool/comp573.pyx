@@ -3,34 +3,9 @@
 
 from libc.stdint cimport uint8_t
 
-cdef extern from *:
-    """
-    template <typename T>
-    T* array_new(int n) {
-        return new T[n];
-    }
-
-    template <typename T>
-    void array_delete(T* x) {
-        delete [] x;
-    }
-    """
-    T* array_new[T](int)
-    void array_delete[T](T* x)
-
 from libcpp.vector cimport vector
 
 
-cdef inline int find_data(unsigned char *data, int data_len, unsigned char c, int offset):
-    while offset < data_len:
-        if data[offset] == c:
-            return offset
-
-        offset += 1
-
-    return -1
-
-
 cpdef bytearray decode_lz(unsigned char *input_data, int data_len):
     cdef bytearray output = bytearray()
     cdef int idx = 0
@@ -180,244 +155,208 @@ cpdef bytearray decode_lz0(unsigned char *data, int data_len):
     return output
 
 
-cpdef bytearray encode_lz(unsigned char *data, int data_len):
-    cdef uint8_t *output = array_new[uint8_t](data_len * 2)
-    cdef int output_len = 0
-    cdef int i = 0
-    cdef int j = 0
-    cdef int v = 0
+cdef enum:
+    LZ_RAW
+    LZ_REPEAT
+    LZ_SHORT_COPY
+    LZ_LONG_COPY
+    LZ_EOF
+
+
+cdef struct lz_command:
+    int cmd
+    int offset
+    int distance
+    int length
+
+
+cdef inline void begin_command(vector[uint8_t] &output, size_t *cmd_offset, int *cmd_bit, bint is_flagged):
+    if cmd_bit[0] == 8:
+        cmd_offset[0] = output.size()
+        output.push_back(0)
+        cmd_bit[0] = 0
+
+    if is_flagged:
+        output[cmd_offset[0]] |= 1 << cmd_bit[0]
+
+    cmd_bit[0] += 1
+
+
+cpdef bytearray encode_lz(unsigned char *data, int data_len, int max_chain=0):
+    # max_chain limits how many history candidates are checked per position.
+    # 0 checks every candidate in the window, which gives the smallest output.
+    cdef vector[int] head = vector[int](0x10000, -1)
+    cdef vector[int] prev = vector[int](max(data_len, 1), -1)
+    cdef vector[lz_command] commands
+    cdef vector[uint8_t] output
+    cdef lz_command command
+    cdef int inserted = 0
+    cdef int offset = 0
     cdef int run_length = 0
-    cdef int last_history_idx = 0
     cdef int history_idx = 0
-    cdef int cmd_offset = 0
+    cdef int history_back_idx = 0
+    cdef int window_start = 0
+    cdef int chain = 0
+    cdef int key = 0
+    cdef int i = 0
+    cdef int j = 0
+    cdef int score = 0
+    cdef int best_score = 0
+    cdef int best_cmd = 0
+    cdef int best_distance = 0
+    cdef int best_length = 0
+    cdef size_t cmd_offset = 0
     cdef int cmd_bit = 0
 
-    cdef int offset = 0
-    cdef list compress_commands = []
-    cdef list history_commands = []
-
-    # Compress runs of previous characters
+    # Step 1: Find runs and history copies
     while offset < data_len:
+        # Add every position that has both bytes of its prefix in the history to the hash chains
+        while inserted + 1 < offset:
+            key = (data[inserted] << 8) | data[inserted + 1]
+            prev[inserted] = head[key]
+            head[key] = inserted
+            inserted += 1
+
         # Run detection
-        if output_len > 0 and data[offset] == output[output_len-1]:
-            c = output[output_len-1]
+        if offset > 0 and data[offset] == data[offset - 1]:
             run_length = 1
 
-            while offset + run_length < data_len and data[offset+run_length] == c and run_length < 0x21:
+            while offset + run_length < data_len and data[offset + run_length] == data[offset] and run_length < 0x21:
                 run_length += 1
 
             if run_length > 1:
-                compress_commands.append([
-                    'repeat',
-                    run_length
-                ])
-
-                j = 0
-                while j < run_length:
-                    output[output_len] = c
-                    output_len += 1
-                    j += 1
+                command.cmd = LZ_REPEAT
+                command.offset = offset
+                command.distance = 1
+                command.length = run_length
+                commands.push_back(command)
 
                 offset += run_length
                 continue
 
-        # History check
-        last_history_idx = max(output_len - 0x400, 0)
-        history_idx = find_data(output, output_len, data[offset], last_history_idx)
-        if history_idx != -1:
-            history_commands.clear()
-
-            while True:
-                history_idx = find_data(output, output_len, data[offset], last_history_idx)
-                last_history_idx = history_idx + 1
-
-                if history_idx == -1:
-                    break
+        # History check. A copy only saves space when at least 2 bytes match, so only
+        # positions sharing the 2 byte prefix are candidates. The chain is walked from the
+        # closest position backwards so ties keep the closest match.
+        best_score = 0
 
-                # Check how long we can match the history
-                i = 1
+        if offset + 1 < data_len:
+            window_start = max(offset - 0x400, 0)
+            history_idx = head[(data[offset] << 8) | data[offset + 1]]
+            chain = 0
 
-                while offset + i < data_len:
-                    if history_idx + i > output_len and output[-1] == data[offset+i]:
-                        # Copy + repeat
-                        i += 1
+            while history_idx >= window_start:
+                history_back_idx = offset - history_idx
 
-                    elif history_idx + i < output_len and output[history_idx+i] == data[offset+i]:
-                        i += 1
+                # Matches can't run past the current position, and matches longer than
+                # the longest copy are never used so stop counting there
+                i = 2
+                while offset + i < data_len and i < history_back_idx and i <= 0x21 and data[history_idx + i] == data[offset + i]:
+                    i += 1
 
-                    else:
-                        break
-
-                history_back_idx = output_len - history_idx
-                if i in [1, 2, 3, 4] and history_back_idx >= 1 and history_back_idx <= 16:
+                score = 0
+                if i <= 4 and history_back_idx <= 16:
                     # Can use a short copy
-                    history_commands.append([
-                        'short_copy',
-                        history_back_idx,
-                        i,
-                        1
-                    ])
+                    score = i - 1
+
+                    if score > best_score:
+                        best_score = score
+                        best_cmd = LZ_SHORT_COPY
+                        best_distance = history_back_idx
+                        best_length = i
 
                 elif history_back_idx <= 0x3ff and i >= 3 and i <= 0x21:
                     # Can use a long copy
-                    history_commands.append([
-                        'long_copy',
-                        history_back_idx,
-                        i,
-                        2
-                    ])
-
-            best_compression = None
-            for x in history_commands:
-                if best_compression is None or x[2] - x[3] >= best_compression[2] - best_compression[3]:
-                    best_compression = x
-
-            if best_compression and best_compression[2] - best_compression[3] > 0:
-                compress_commands.append(best_compression)
-
-                j = 0
-                while j < best_compression[2]:
-                    output[output_len] = data[offset]
-                    output_len += 1
-                    offset += 1
-                    j += 1
-
-                continue
-
-        compress_commands.append([
-            'raw',
-            data[offset]
-        ])
-
-        output[output_len] = data[offset]
-        output_len += 1
-        offset += 1
+                    score = i - 2
 
-    compress_commands.append(['eof'])
+                    if score > best_score:
+                        best_score = score
+                        best_cmd = LZ_LONG_COPY
+                        best_distance = history_back_idx
+                        best_length = i
 
-    # Step 2: Compress down raw runs
-    # Step 3: Build down repeat commands
-    compress_commands2 = []
-    i = 0
-    compress_commands_len = len(compress_commands)
-    while i < compress_commands_len:
-        if compress_commands[i][0] == 'raw':
-            run_length = 1
-
-            while compress_commands[i+run_length][0] == 'raw':
-                run_length += 1
-
-            if run_length == 1:
-                compress_commands2.append(compress_commands[i])
-                i += 1
-                continue
-
-            raw_bulk = bytearray()
-            for j in range(run_length):
-                raw_bulk.append(compress_commands[i+j][1])
+                if best_score == 0x21 - 2:
+                    break
 
-            while len(raw_bulk) > 7:
-                copy_len = min(len(raw_bulk), 0x46)
-                chunk = raw_bulk[:copy_len]
-                raw_bulk = raw_bulk[copy_len:]
+                chain += 1
+                if max_chain > 0 and chain >= max_chain:
+                    break
 
-                compress_commands2.append([
-                    'raw_bulk',
-                    chunk,
-                    len(chunk)
-                ])
+                history_idx = prev[history_idx]
 
-            while len(raw_bulk) > 0:
-                copy_len = 1
-                chunk = raw_bulk[:copy_len]
-                raw_bulk = raw_bulk[copy_len:]
+        if best_score > 0:
+            command.cmd = best_cmd
+            command.offset = offset
+            command.distance = best_distance
+            command.length = best_length
+            commands.push_back(command)
 
-                compress_commands2.append([
-                    'raw',
-                    chunk[0]
-                ])
+            offset += best_length
+            continue
 
-            i += run_length
+        command.cmd = LZ_RAW
+        command.offset = offset
+        command.distance = 0
+        command.length = 1
+        commands.push_back(command)
 
-        elif compress_commands[i][0] == 'repeat':
-            history_back_idx = 1
-            length = compress_commands[i][1]
+        offset += 1
 
-            while length > 0:
-                if length in [1, 2, 3, 4] and history_back_idx >= 1 and history_back_idx <= 16:
-                    copy_len = length
+    command.cmd = LZ_EOF
+    command.offset = offset
+    command.distance = 0
+    command.length = 0
+    commands.push_back(command)
 
-                    # Can use a short copy
-                    compress_commands2.append([
-                        'short_copy',
-                        history_back_idx,
-                        copy_len,
-                        1
-                    ])
+    # Step 2: Build actual data now, packing runs of raw bytes into bulk copies
+    output.push_back(0)
 
-                    length -= copy_len
+    i = 0
+    while i < <int>commands.size():
+        command = commands[i]
 
-                elif history_back_idx <= 0x3ff and length >= 3:
-                    copy_len = min(length, 0x21)
+        if command.cmd == LZ_RAW:
+            run_length = 1
 
-                    # Can use a long copy
-                    compress_commands2.append([
-                        'long_copy',
-                        history_back_idx,
-                        copy_len,
-                        2
-                    ])
+            while commands[i + run_length].cmd == LZ_RAW:
+                run_length += 1
 
-                    length -= copy_len
+            # Raw commands that follow each other are always for consecutive bytes
+            offset = command.offset
+            if run_length > 1:
+                while run_length - (offset - command.offset) > 7:
+                    j = min(run_length - (offset - command.offset), 0x46)
 
-            i += 1
+                    # 1 + x bytes
+                    begin_command(output, &cmd_offset, &cmd_bit, True)
+                    output.push_back(0xb9 + j - 1)
 
-        else:
-            compress_commands2.append(compress_commands[i])
-            i += 1
+                    while j > 0:
+                        output.push_back(data[offset])
+                        offset += 1
+                        j -= 1
 
-    output_buffer = bytearray([0])
-    cmd_offset = 0
-    cmd_bit = 0
+            while offset < command.offset + run_length:
+                begin_command(output, &cmd_offset, &cmd_bit, False)
+                output.push_back(data[offset])
+                offset += 1
 
-    # Step 4: Build actual data now
-    for x in compress_commands2:
-        # print("%04x" % len(output_buffer), x)
+            i += run_length
+            continue
 
-        if cmd_bit == 8:
-            cmd_offset = len(output_buffer)
-            output_buffer += int.to_bytes(0, 1, 'little')
-            cmd_bit = 0
+        begin_command(output, &cmd_offset, &cmd_bit, True)
 
-        if x[0] == 'raw':
-            output_buffer += int.to_bytes(x[1], 1, 'little')
+        if command.cmd == LZ_EOF:
+            output.push_back(0xff)
 
-        elif x[0] == 'eof':
-            output_buffer[cmd_offset] |= 1 << cmd_bit
-            output_buffer += int.to_bytes(0xff, 1, 'little')
+        elif command.cmd == LZ_SHORT_COPY or (command.cmd == LZ_REPEAT and command.length <= 4):
+            # 1 byte
+            output.push_back(((command.length + 6) << 4) | (command.distance - 1))
 
         else:
-            output_buffer[cmd_offset] |= 1 << cmd_bit
-
-            if x[0] == 'raw_bulk':
-                # 1 + x bytes
-                output_buffer += int.to_bytes(0xb9 + len(x[1]) - 1, 1, 'little')
-                output_buffer += x[1]
-
-            elif x[0] == 'short_copy':
-                # 1 byte
-                v = ((x[2] + 6) << 4) | (x[1] - 1)
-                output_buffer += int.to_bytes(v, 1, 'little')
-
-            elif x[0] == 'long_copy':
-                # 2 bytes
-                v = (((x[2] - 3) << 2) << 8) | (x[1] & 0x3ff)
-                output_buffer += int.to_bytes(v, 2, 'big')
-
-        # if len(output_buffer) >= 0x170:
-        #     exit(1)
-
-        cmd_bit += 1
+            # 2 bytes
+            output.push_back(((command.length - 3) << 2) | ((command.distance >> 8) & 0x03))
+            output.push_back(command.distance & 0xff)
 
-    return output_buffer
+        i += 1
 
+    return bytearray((<char*>output.data())[:output.size()])
@@ -1,9 +1,14 @@
 import argparse
+import bisect
+import collections
 import ctypes
+import hashlib
 import json
+import mmap
 import os
 import pickle
 import string
+import struct
 
 import enc573
 from comp573 import decode_lz, decode_lz0
@@ -62,14 +67,8 @@ def decrypt_data(data, input_key):
 
     val = 0x41C64E6D
     key1 = (val * calculate_key(input_key)) & 0xffffffff
-    counter = 0
 
-    for idx, c in enumerate(data):
-        val = ((key1 + counter) >> 5) ^ c
-        data[idx] = val & 0xff
-        counter += 0x3039
-
-    return data
+    return enc573.crypt_data(data, key1)
 
 
 common_extensions = [
@@ -622,6 +621,80 @@ def read_file_table_gfdm3(card_filename, table_offset, forced_secondary=False):
     return files
 
 
+# Parsers that add every filename they read to hash_list, even for tables that end up not matching
+NAMED_FILE_TABLE_PARSERS = [read_file_table_ddr_dancingstage, read_file_table_gfdm4, read_file_table_gfdm3]
+
+
+def probe_file_table(f, filename, table_offset):
+    # Check only the first entry of the table so layouts that can't possibly match
+    # are rejected without running the full parser
+    if not os.path.exists(filename):
+        return False
+
+    dat_size = os.path.getsize(filename)
+
+    if table_offset + 0x10 > dat_size:
+        return False
+
+    with open(filename, "rb") as infile:
+        infile.seek(table_offset)
+        header = infile.read(0x10)
+
+        infile.seek(table_offset + 0x800)
+        header_alt = infile.read(2)
+
+    if f == read_file_table_ddr:
+        filename_hash, offset, flag_loc, flag_comp, flag_enc, unk, filesize = struct.unpack("<IHHBBHI", header)
+
+        if (filename_hash == 0xffffffff and offset == 0xffff) or (filename_hash == 0 and offset == 0 and filesize == 0):
+            return False
+
+        return flag_loc <= 1 and flag_comp <= 2 and flag_enc <= 1 and offset < 0x8000 and filesize < dat_size
+
+    elif f in [read_file_table_ddr_dancingstage, read_file_table_gfdm4]:
+        # The table may be shifted by an extra header so check both possible locations
+        for flag in [int.from_bytes(header[:2], 'little'), int.from_bytes(header_alt, 'little')]:
+            if flag in [0, 4, 0x0a, 0x0b, 0x0c, 0x0d, 0x0e] or (flag & 0xff) == 1:
+                return True
+
+        return False
+
+    elif f == read_file_table_gfdm:
+        filename_hash, offset, filesize, flag = struct.unpack("<IIII", header)
+
+        if (filename_hash == 0 and offset == 0 and filesize == 0 and flag == 0) or (filename_hash == 0xffffffff and offset == 0xffffffff):
+            return False
+
+        return flag <= 0x0f
+
+    elif f == read_file_table_gfdm2:
+        filename_hash, offset, flag, filesize = struct.unpack("<IIII", header)
+
+        if filename_hash in [0, 0xffffffff] and offset in [0, 0xffffffff]:
+            return False
+
+        return flag == 0
+
+    elif f == read_file_table_gfdm3:
+        return header[0] in [1, 2]
+
+    return True
+
+
+def get_image_signature(filenames):
+    # Identifies a set of DATs by their sizes and a hash of their first MB
+    signature = []
+
+    for filename in sorted(set(filenames)):
+        if not os.path.exists(filename):
+            continue
+
+        with open(filename, "rb") as infile:
+            signature.append("%s:%d:%s" % (os.path.basename(filename), os.path.getsize(filename), hashlib.md5(infile.read(0x100000)).hexdigest()))
+
+    return "|".join(signature)
+
+
 def get_card_filenames(input_folder, main_card_filename=None):
     game_filename = None
     card_filename = None
@@ -705,44 +778,134 @@ def get_file_from_dancingstage(reader, fileinfo):
     return data
 
 
-def get_file_data(input_folder, fileinfo, enckey=None):
-    game_filename, card_filename = get_card_filenames(input_folder, fileinfo.get('_main_card_filename', None))
+class RegionSet:
+    def __init__(self):
+        # Sorted, non-overlapping [start, end) extents, adjacent extents are coalesced
+        self.starts = []
+        self.ends = []
 
-    game = open(game_filename, "rb") if game_filename else None
-    card = open(card_filename, "rb") if card_filename else None
 
-    data = None
-    if fileinfo['flag_loc'] == 1:
-        if card:
-            card.seek(fileinfo['offset'])
+    def add(self, start, end):
+        if end <= start:
+            return
 
-            if fileinfo.get('_is_dancingstage', False):
-                data = get_file_from_dancingstage(card, fileinfo)
+        # Find every extent that overlaps or touches the new one and merge them
+        left = bisect.bisect_left(self.ends, start)
+        right = bisect.bisect_right(self.starts, end)
 
-            else:
-                data = bytearray(card.read(fileinfo['filesize']))
+        if left < right:
+            start = min(start, self.starts[left])
+            end = max(end, self.ends[right - 1])
 
-    else:
-        if game:
-            game.seek(fileinfo['offset'])
+        self.starts[left:right] = [start]
+        self.ends[left:right] = [end]
+
+
+    def gaps(self, size):
+        # Yields the unused [start, end) ranges between 0 and size
+        cur = 0
+
+        for start, end in zip(self.starts, self.ends):
+            if start >= size:
+                break
+
+            if start > cur:
+                yield cur, start
+
+            cur = max(cur, end)
+
+        if cur < size:
+            yield cur, size
+
+
+class CardReader:
+    def __init__(self, input_folder, cache_size=0x4000000):
+        # Each DAT is opened and memory mapped once per dump, and decoded file payloads
+        # are kept in an LRU bounded by cache_size bytes
+        self.input_folder = input_folder
+        self.card_filenames = {}
+        self.cards = {}
+
+        self.cache_size = cache_size
+        self.cache_used = 0
+        self.cache = collections.OrderedDict()
 
+
+    def get_card_filenames(self, main_card_filename=None):
+        if main_card_filename not in self.card_filenames:
+            self.card_filenames[main_card_filename] = get_card_filenames(self.input_folder, main_card_filename)
+
+        return self.card_filenames[main_card_filename]
+
+
+    def open_card(self, filename):
+        if filename is None:
+            return None
+
+        if filename not in self.cards:
+            with open(filename, "rb") as infile:
+                self.cards[filename] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.cards[filename]
+
+
+    def read_file_data(self, fileinfo, enckey=None):
+        game_filename, card_filename = self.get_card_filenames(fileinfo.get('_main_card_filename', None))
+
+        if fileinfo['flag_loc'] == 1:
+            reader = self.open_card(card_filename)
+
+        else:
+            reader = self.open_card(game_filename)
+
+        data = None
+        if reader:
             if fileinfo.get('_is_dancingstage', False):
-                data = get_file_from_dancingstage(game, fileinfo)
+                data = get_file_from_dancingstage(reader, fileinfo)
 
             else:
-                data = bytearray(game.read(fileinfo['filesize']))
+                data = bytearray(reader[fileinfo['offset']:fileinfo['offset']+fileinfo['filesize']])
 
-    if data and fileinfo['flag_enc'] != 0 and enckey:
-        data = decrypt_data(data, enckey)
+        if data and fileinfo['flag_enc'] != 0 and enckey:
+            data = decrypt_data(data, enckey)
 
-    if data and fileinfo['flag_comp'] == 1:
-        try:
-            data = decode_lz(data, len(data))
+        if data and fileinfo['flag_comp'] == 1:
+            try:
+                data = decode_lz(data, len(data))
 
-        except IndexError:
-            pass
+            except IndexError:
+                pass
+
+        return bytes(data)
+
+
+    def get_file_data(self, fileinfo, enckey=None):
+        cache_key = (fileinfo['filename_hash'], fileinfo.get('_main_card_filename', None), fileinfo['flag_loc'], fileinfo['offset'], enckey)
+
+        if cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+
+        else:
+            data = self.read_file_data(fileinfo, enckey)
+
+            self.cache[cache_key] = data
+            self.cache_used += len(data)
+
+            while self.cache_used > self.cache_size and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_used -= len(evicted)
+
+        # Callers are free to modify the returned data so always hand out a copy
+        return bytearray(self.cache[cache_key])
+
+
+    def close(self):
+        for k in self.cards:
+            self.cards[k].close()
 
-    return bytearray(data)
+        self.cards = {}
+        self.cache.clear()
+        self.cache_used = 0
 
 
 def dump_data(input_folder, output_folder, candidate_result, main_card_filename=None, dump_unreference=False):
@@ -752,20 +915,23 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
 
     files = candidate_result[1]
 
-    game_filename, card_filename = get_card_filenames(input_folder, main_card_filename)
+    reader = CardReader(input_folder)
+    game_filename, card_filename = reader.get_card_filenames(main_card_filename)
 
     used_regions = {}
 
     if game_filename:
         used_regions[0] = {
             'filename': game_filename,
-            'data': [0] * os.path.getsize(game_filename),
+            'size': os.path.getsize(game_filename),
+            'regions': RegionSet(),
         }
 
     if card_filename:
         used_regions[1] = {
             'filename': card_filename,
-            'data': [0] * os.path.getsize(card_filename),
+            'size': os.path.getsize(card_filename),
+            'regions': RegionSet(),
         }
 
         # Try to parse secondary card
@@ -795,11 +961,11 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
                     candidate_key_count = 0
 
                     for cur_key in ['EXTREME', 'EURO2', 'MAX2', 'DDR5', 'MAMBO']:
-                        mdb1 = parse_mdb_filenames(get_file_data(input_folder, f, cur_key), 0x2c, [], True)
-                        mdb2 = parse_mdb_filenames(get_file_data(input_folder, f, cur_key), 0x30, [], True)
-                        mdb3 = parse_mdb_filenames(get_file_data(input_folder, f, cur_key), 0x64, [], True)
-                        mdb4 = parse_mdb_filenames(get_file_data(input_folder, f, cur_key), 0x6c, [], True)
-                        mdb5 = parse_mdb_filenames(get_file_data(input_folder, f, cur_key), 0x80, [], True)
+                        mdb1 = parse_mdb_filenames(reader.get_file_data(f, cur_key), 0x2c, [], True)
+                        mdb2 = parse_mdb_filenames(reader.get_file_data(f, cur_key), 0x30, [], True)
+                        mdb3 = parse_mdb_filenames(reader.get_file_data(f, cur_key), 0x64, [], True)
+                        mdb4 = parse_mdb_filenames(reader.get_file_data(f, cur_key), 0x6c, [], True)
+                        mdb5 = parse_mdb_filenames(reader.get_file_data(f, cur_key), 0x80, [], True)
 
                         for mdb in [mdb1, mdb2, mdb3, mdb4, mdb5]:
                             if len(mdb) > candidate_key_count:
@@ -813,7 +979,7 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
     for idx, fileinfo in enumerate(files):
         if fileinfo['filename_hash'] == 0x45fda52a or (fileinfo['filename_hash'] in hash_list and hash_list[fileinfo['filename_hash']].endswith("config.dat")): # Just try to decrypt any config.dat
             try:
-                config = decrypt_data_internal(get_file_data(input_folder, fileinfo, game_key), "/s573/config.dat")
+                config = decrypt_data_internal(reader.get_file_data(fileinfo, game_key), "/s573/config.dat")
                 open(os.path.join(output_folder, "_config.txt"), "wb").write(config)
 
                 config = config.decode('shift-jis')
@@ -835,50 +1001,50 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
 
         if fileinfo['filename_hash'] in hash_list:
             if hash_list[fileinfo['filename_hash']] in ["data/tex/rembind.bin", "data/all/texbind.bin"]:
-                hash_list = parse_rembind_filenames(get_file_data(input_folder, fileinfo, game_key), hash_list)
+                hash_list = parse_rembind_filenames(reader.get_file_data(fileinfo, game_key), hash_list)
 
             if hash_list[fileinfo['filename_hash']] == "data/mdb/mdb.bin":
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x2c, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x30, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x64, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x6c, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x80, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x2c, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x30, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x64, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x6c, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x80, hash_list)
 
             if hash_list[fileinfo['filename_hash']] == "data/music/cd1.db":
-                hash_list = parse_db_filenames(get_file_data(input_folder, fileinfo, game_key), hash_list)
+                hash_list = parse_db_filenames(reader.get_file_data(fileinfo, game_key), hash_list)
 
             if hash_list[fileinfo['filename_hash']] in ["data/mdb/ja_mdb.bin", "data/mdb/ka_mdb.bin",
                                                             "data/mdb/aa_mdb.bin", "data/mdb/ea_mdb.bin",
                                                             "data/mdb/ua_mdb.bin"]:
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x38, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x6c, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x38, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x6c, hash_list)
 
             if hash_list[fileinfo['filename_hash']] == "group_list.bin":
-                hash_list = parse_group_list_filenames(get_file_data(input_folder, fileinfo, game_key), hash_list)
+                hash_list = parse_group_list_filenames(reader.get_file_data(fileinfo, game_key), hash_list)
 
             if hash_list[fileinfo['filename_hash']] == "ja_mdb.bin":
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key)[0x10:], 0x24, hash_list)
-                hash_list = parse_mdb_filenames(get_file_data(input_folder, fileinfo, game_key), 0x38, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key)[0x10:], 0x24, hash_list)
+                hash_list = parse_mdb_filenames(reader.get_file_data(fileinfo, game_key), 0x38, hash_list)
 
             elif hash_list[fileinfo['filename_hash']] == "arrangement_data.bin":
                 try:
-                    hash_list = parse_group_list_filenames_dmx(get_file_data(input_folder, fileinfo, game_key), hash_list)
+                    hash_list = parse_group_list_filenames_dmx(reader.get_file_data(fileinfo, game_key), hash_list)
                 except:
                     pass
 
                 try:
-                    hash_list = parse_group_list_filenames_dmx(get_file_data(input_folder, fileinfo, game_key), hash_list, True)
+                    hash_list = parse_group_list_filenames_dmx(reader.get_file_data(fileinfo, game_key), hash_list, True)
                 except:
                     pass
 
             elif hash_list[fileinfo['filename_hash']] == "object_2d_data.bin":
                 try:
-                    hash_list = parse_group_list_filenames_dmx(get_file_data(input_folder, fileinfo, game_key), hash_list)
+                    hash_list = parse_group_list_filenames_dmx(reader.get_file_data(fileinfo, game_key), hash_list)
                 except:
                     pass
 
                 try:
-                    hash_list = parse_group_list_filenames_dmx(get_file_data(input_folder, fileinfo, game_key), hash_list, True)
+                    hash_list = parse_group_list_filenames_dmx(reader.get_file_data(fileinfo, game_key), hash_list, True)
                 except:
                     pass
 
@@ -910,7 +1076,7 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
         if (region_size % 0x800) != 0:
             region_size += 0x800 - (region_size % 0x800)
 
-        used_regions[fileinfo['flag_loc']]['data'][fileinfo['offset']:region_size] = [1] * (region_size - fileinfo['offset'])
+        used_regions[fileinfo['flag_loc']]['regions'].add(fileinfo['offset'], region_size)
 
         if os.path.exists(output_filename):
             continue
@@ -922,7 +1088,7 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
         print(fileinfo)
         print("Extracting", output_filename)
 
-        data = get_file_data(input_folder, fileinfo, game_key)
+        data = reader.get_file_data(fileinfo, game_key)
 
         try:
             try_find_ext = output_filename.endswith(".lz") or output_filename.endswith(".lz0")
@@ -949,34 +1115,26 @@ def dump_data(input_folder, output_folder, candidate_result, main_card_filename=
         with open(output_filename, "wb") as outfile:
             outfile.write(data)
 
+    reader.close()
+
     json.dump({'files': files}, open(os.path.join(output_folder, "_metadata.json"), "w"), indent=4)
 
     if dump_unreference:
         unreferenced_path = os.path.join(output_folder, "#unreferenced")
         for k in used_regions:
-            data = bytearray(open(os.path.join(input_folder, used_regions[k]['filename']), "rb").read())
+            data = open(os.path.join(input_folder, used_regions[k]['filename']), "rb").read()
 
             # Find and dump unreferenced regions with data in them
-            start = 0
-            while start < len(used_regions[k]['data']):
-                if used_regions[k]['data'][start] == 0:
-                    end = start
-
-                    while end < len(used_regions[k]['data']) and used_regions[k]['data'][end] == 0:
-                        end += 1
-
-                    if len([x for x in data[start:end] if x != 0]) > 0 and len([x for x in data[start:end] if x != 0xff]) > 0:
-                        if not os.path.exists(unreferenced_path):
-                            os.makedirs(unreferenced_path)
+            for start, end in used_regions[k]['regions'].gaps(used_regions[k]['size']):
+                region = data[start:end]
 
-                        print("Found unreferenced data @ %08x - %08x" % (start, end))
+                if region.strip(b"\x00") and region.strip(b"\xff"):
+                    if not os.path.exists(unreferenced_path):
+                        os.makedirs(unreferenced_path)
 
-                        open(os.path.join(unreferenced_path, "%d_%08x.bin" % (k, start)), "wb").write(data[start:end])
+                    print("Found unreferenced data @ %08x - %08x" % (start, end))
 
-                    start = end + 1
-
-                else:
-                    start += 1
+                    open(os.path.join(unreferenced_path, "%d_%08x.bin" % (k, start)), "wb").write(region)
 
 
 def main():
@@ -989,6 +1147,7 @@ def main():
     parser.add_argument('--input', help='Input folder', default=None, required=True)
     parser.add_argument('--output', help='Output folder', default="output")
     parser.add_argument('--dump-unreferenced', help='Dump unreferenced regions', default=False, action="store_true")
+    parser.add_argument('--layout-cache', help='File used to cache detected file table layouts (optional)', default=None)
 
     args, _ = parser.parse_known_args()
 
@@ -1062,10 +1221,35 @@ def main():
     filetables.append((read_file_table_gfdm2, 0x100000, os.path.join(args.input, "GQ886UA.DAT"), 1))
     filetables.append((read_file_table_gfdm2, 0x1b8000, os.path.join(args.input, "GE929JA.DAT"), 1)) # Guitar Freaks Link Kit 1
 
+    # Skip detection entirely for images that have been seen before
+    layout_cache = {}
+    cached_layouts = None
+    if args.layout_cache:
+        if os.path.exists(args.layout_cache):
+            layout_cache = json.load(open(args.layout_cache))
+
+        image_signature = get_image_signature([t[2] for t in filetables])
+        cached_layouts = layout_cache.get(image_signature, None)
+
     filetable_results = []
     for i, t in enumerate(filetables):
         try:
             f, offset, filename, result_type = t
+
+            if cached_layouts is not None:
+                is_candidate = [f.__name__, offset, os.path.basename(filename)] in cached_layouts
+
+            else:
+                is_candidate = probe_file_table(f, filename, offset)
+
+            if not is_candidate:
+                # Tables with filenames are still read for the names they add to hash_list.
+                # A table that fails the probe fails on its first entry before any names are read.
+                if f in NAMED_FILE_TABLE_PARSERS and probe_file_table(f, filename, offset):
+                    f(filename, offset)
+
+                continue
+
             results = f(filename, offset)
 
             if results:
@@ -1099,6 +1283,10 @@ def main():
         if is_good:
             candidate_results.append((t, results, filename))
 
+    if args.layout_cache and cached_layouts is None and candidate_results:
+        layout_cache[image_signature] = [[t[0].__name__, t[1], os.path.basename(t[2])] for t, _, _ in candidate_results]
+        json.dump(layout_cache, open(args.layout_cache, "w"), indent=4)
+
     for candidate_idx, candidate in enumerate(candidate_results):
         if len(candidate_results) > 1:
             output_folder = os.path.join(args.output, "%d" % candidate_idx)
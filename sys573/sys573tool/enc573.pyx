@@ -16,6 +16,21 @@ cpdef unsigned int get_filename_hash(unsigned char *filename, unsigned int filen
     return hash & 0xffffffff
 
 
+cpdef bytearray crypt_data(bytearray data, unsigned int key1):
+    # The key byte only depends on the index, so encryption and decryption are the same operation
+    cdef unsigned char *buf = data
+    cdef unsigned long long counter = key1
+    cdef size_t idx = 0
+    cdef size_t data_len = len(data)
+
+    while idx < data_len:
+        buf[idx] ^= (counter >> 5) & 0xff
+        counter += 0x3039
+        idx += 1
+
+    return data
+
+
 cdef rot(int c):
     return ((c >> 7) & 1) | ((c << 1) & 0xff)
 
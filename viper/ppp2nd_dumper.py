@@ -3,53 +3,66 @@ import ctypes
 import os
 import string
 import struct
+import sys
 
+import numpy as np
 
-def get_filename_hash(filename):
-    hash = 0
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
 
-    for cidx, c in enumerate(filename):
-        for i in range(6):
-            hash = ctypes.c_int(((hash >> 31) & 0x4c11db7) ^ ((hash << 1) | ((ord(c) >> i) & 1))).value
+from gcz import decompress_gcz
 
-    return hash & 0xffffffff
 
+CHUNK_SIZE = 0x100000
 
-def decompress_gcz(data):
-    data_length = len(data)
-    offset = 0
-    output = []
 
-    while offset < data_length:
-        flag = data[offset]
-        offset += 1
+def get_checksum(data, checksum=0):
+    # Running 32-bit sum of all bytes
+    return (checksum + int(np.frombuffer(data, dtype=np.uint8).sum(dtype=np.uint64))) & 0xffffffff
 
-        for bit in range(8):
-            if flag & (1 << bit):
-                output.append(data[offset])
-                offset += 1
 
-            else:
-                if offset + 2 > data_length:
-                    break
+def extract_entry(infile, outfile, entry, is_zin):
+    if entry['decomp_size'] == 0:
+        # Uncompressed data can be copied and checksummed a chunk at a time
+        checksum = 0
+        remaining = entry['size']
 
-                cmd1, cmd2 = data[offset:offset+2]
-                lookback_length = (cmd1 & 0x0f) + 3
-                lookback_offset = ((cmd1 & 0xf0) << 4) + cmd2
-                offset += 2
+        while remaining > 0:
+            data = infile.read(min(remaining, CHUNK_SIZE))
 
-                if cmd1 == 0 and cmd2 == 0:
-                    break
+            if not data:
+                break
+
+            checksum = get_checksum(data, checksum)
+            outfile.write(data)
+            remaining -= len(data)
+
+        return checksum
+
+    data = infile.read(entry['size'])
 
-                for _ in range(lookback_length):
-                    loffset = len(output) - lookback_offset
-                    if loffset <= 0 or loffset >= len(output):
-                        output.append(0)
+    if is_zin:
+        # .zin files (and the bootloader) are supposed to be checksummed before decompression
+        checksum = get_checksum(data)
 
-                    else:
-                        output.append(output[loffset])
+    data = decompress_gcz(data, entry['decomp_size'])
 
-    return bytearray(output)
+    if not is_zin:
+        # Calculate checksum of extracted data
+        checksum = get_checksum(data)
+
+    outfile.write(data)
+
+    return checksum
+
+
+def get_filename_hash(filename):
+    hash = 0
+
+    for cidx, c in enumerate(filename):
+        for i in range(6):
+            hash = ctypes.c_int(((hash >> 31) & 0x4c11db7) ^ ((hash << 1) | ((ord(c) >> i) & 1))).value
+
+    return hash & 0xffffffff
 
 
 if __name__ == "__main__":
@@ -858,21 +871,8 @@ if __name__ == "__main__":
                 os.makedirs(basedir)
 
             with open(output_filename, "wb") as outfile:
-                data = infile.read(entry['size'])
-
                 is_zin = output_filename.endswith(".zin") or entry['filename_hash'] in [0x90547703]
-                if is_zin:
-                    # .zin files (and the bootloader) are supposed to be checksummed before decompression
-                    checksum = sum(data) & 0xffffffff
-
-                if entry['decomp_size'] != 0:
-                    data = decompress_gcz(data)
-
-                if not is_zin:
-                    # Calculate checksum of extracted data
-                    checksum = sum(data) & 0xffffffff
-
-                outfile.write(data)
+                checksum = extract_entry(infile, outfile, entry, is_zin)
 
             if checksum != entry['checksum']:
                 print("Invalid checksum for extracted data!")